@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from functools import lru_cache
+import os
+import requests
+from google import genai
+from app.services.clients import create_genai_client, create_nmc_session
+from app.services.gemini_service import GeminiOCRService
+from app.services.doctor_verification_service import DoctorVerificationService
+from app.services.medicine_safety_service import MedicineSafetyService
+from app.services.medical_chat_service import MedicalChatService
+
+
+# Cap on concurrent upstream (Gemini / NMC) calls so bursts stay within API rate limits
+MAX_CONCURRENT_UPSTREAM_CALLS = int(os.environ.get("MAX_CONCURRENT_UPSTREAM_CALLS", "8"))
+
+
+# Shared upstream clients: one keep-alive pool per process instead of one per service
+@lru_cache(maxsize=1)
+def get_genai_client() -> genai.Client:
+    """Process-wide Gemini client."""
+    return create_genai_client()
+
+
+@lru_cache(maxsize=1)
+def get_nmc_session() -> requests.Session:
+    """Process-wide NMC registry session."""
+    return create_nmc_session()
+
+
+@lru_cache(maxsize=1)
+def get_upstream_semaphore() -> asyncio.Semaphore:
+    """Process-wide cap on in-flight upstream calls, shared by routes and async services."""
+    return asyncio.Semaphore(MAX_CONCURRENT_UPSTREAM_CALLS)
+
+
+@lru_cache(maxsize=1)
+def get_upstream_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool for blocking Gemini / NMC calls.
+    
+    Sized to the upstream concurrency limit and kept apart from the default
+    executor, so slow upstream calls can't starve CPU work offloaded there.
+    """
+    return ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_UPSTREAM_CALLS,
+        thread_name_prefix="upstream"
+    )
+
+
+# Service singletons, injected into routes with Depends()
+@lru_cache(maxsize=1)
+def get_gemini_service() -> GeminiOCRService:
+    """Prescription OCR service."""
+    return GeminiOCRService(client=get_genai_client())
+
+
+@lru_cache(maxsize=1)
+def get_doctor_verification_service() -> DoctorVerificationService:
+    """NMC doctor verification service."""
+    return DoctorVerificationService(similarity_threshold=0.2, session=get_nmc_session())
+
+
+@lru_cache(maxsize=1)
+def get_medicine_safety_service() -> MedicineSafetyService:
+    """Medicine safety check service."""
+    return MedicineSafetyService(client=get_genai_client(), concurrency_limit=get_upstream_semaphore())
+
+
+@lru_cache(maxsize=1)
+def get_medical_chat_service() -> MedicalChatService:
+    """Medical intake chat service."""
+    return MedicalChatService(client=get_genai_client())
+
+
+def init_services():
+    """Instantiate every service at startup so the first request doesn't pay for it."""
+    get_gemini_service()
+    get_doctor_verification_service()
+    get_medicine_safety_service()
+    get_medical_chat_service()
+
+
+async def close_upstream_clients():
+    """Release pooled upstream connections and worker threads on application shutdown."""
+    get_upstream_executor().shutdown(wait=False, cancel_futures=True)
+    get_nmc_session().close()
+    client = get_genai_client()
+    await client.aio.aclose()
+    client.close()
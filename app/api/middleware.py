@@ -0,0 +1,40 @@
+from fastapi.responses import JSONResponse
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject multipart uploads whose declared Content-Length is over the limit.
+
+    FastAPI parses (and spools) the whole multipart body before a route handler
+    runs, so the size check inside the handler only fires after the upload has
+    been received. Checking the header here answers before the body is read.
+    Chunked uploads without a Content-Length still hit the in-handler check.
+    """
+
+    def __init__(self, app, max_body_size: int):
+        """
+        Args:
+            app: Wrapped ASGI application
+            max_body_size: Largest accepted multipart request body, in bytes
+        """
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = dict(scope["headers"])
+            content_type = headers.get(b"content-type", b"")
+            content_length = headers.get(b"content-length", b"")
+            if (
+                content_type.startswith(b"multipart/form-data")
+                and content_length.isdigit()
+                and int(content_length) > self.max_body_size
+            ):
+                response = JSONResponse(
+                    status_code=413,
+                    content={"detail": "Request body too large. Maximum file size: 10MB"}
+                )
+                await response(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
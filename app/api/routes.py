@@ -1,34 +1,328 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from app.models.schemas import (
     OCRResponse, PrescriptionData, DoctorInfo, PatientInfo, Medicine,
     DoctorVerificationResponse, VerifyDoctorRequest, NMCDoctorRecord,
     MedicineSafetyRequest, MedicineSafetyResponse, MedicineFlagResult,
-    MedicalChatRequest, MedicalChatResponse, ChatMessage, MedicalInformation
+    PrescriptionValidationResponse,
+    MedicalChatRequest, MedicalChatResponse
+)
+from app.api.dependencies import (
+    get_upstream_executor, get_upstream_semaphore,
+    get_gemini_service, get_doctor_verification_service,
+    get_medicine_safety_service, get_medical_chat_service
 )
 from app.services.gemini_service import GeminiOCRService
 from app.services.doctor_verification_service import DoctorVerificationService
 from app.services.medicine_safety_service import MedicineSafetyService
 from app.services.medical_chat_service import MedicalChatService
+from collections.abc import Mapping
+from functools import partial
+from typing import Dict, List, Optional
+import asyncio
+import base64
+import binascii
 import logging
+import orjson
+import re
 
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1", tags=["prescription"])
 
-# Initialize services
-gemini_service = GeminiOCRService()
-doctor_verification_service = DoctorVerificationService(similarity_threshold=0.2)
-medicine_safety_service = MedicineSafetyService()
-medical_chat_service = MedicalChatService()
+# Cap concurrent upstream (Gemini / NMC) calls so bursts stay within API rate limits
+_upstream_semaphore = get_upstream_semaphore()
+
+# Key mapping: Gemini may return various key formats for medicine fields
+_MEDICINE_KEY_MAP = {
+    "medicine name": "medicine_name",
+    "medicine_name": "medicine_name",
+    "medicinename": "medicine_name",
+    "name": "medicine_name",
+    "dosage": "dosage",
+    "dosage amount": "dosage",
+    "dosage_instruction": "dosage_instruction",
+    "dosage instruction": "dosage_instruction",
+    "dosageinstruction": "dosage_instruction",
+    "frequency": "dosage_instruction",
+    "timing": "timing",
+    "duration": "duration",
+}
+_MEDICINE_FIELDS = frozenset(Medicine.model_fields)
+
+# "User: ..." / "Assistant: ..." / "Bot: ..." history strings, matched in a single pass
+_ROLE_PREFIX_RE = re.compile(r"\s*(user|assistant|bot)\s*:\s*(.*?)\s*\Z", re.IGNORECASE | re.DOTALL)
+_ROLE_ALIASES = {"bot": "assistant", "model": "assistant"}
+
+# Alternative key names for dict-style history messages, in priority order
+_ROLE_KEYS = ("role", "sender")
+_CONTENT_KEYS = ("content", "text", "message")
+
+# Accepted prescription uploads
+_ALLOWED_MIME_TYPES = frozenset({
+    "application/pdf",
+    "image/jpeg",
+    "image/jpg",
+    "image/png",
+})
+_MAX_UPLOAD_SIZE = 10 << 20  # 10MB
+
+# Whole multipart request cap: one upload plus room for boundaries and form fields
+MAX_UPLOAD_REQUEST_SIZE = _MAX_UPLOAD_SIZE + (1 << 20)
+
+# Uploads are read in fixed-size chunks so oversize files are rejected early
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Health check body is static, so it is serialized once at import time
+_HEALTH_BODY = orjson.dumps({
+    "status": "healthy",
+    "message": "Medicine Verification Service is running"
+})
+_HEALTH_HEADERS = {"Cache-Control": "public, max-age=5"}
+
+# Longest audio_base64 accepted: the base64 length of a maximum-size upload
+_MAX_AUDIO_BASE64_LENGTH = 4 * -(-_MAX_UPLOAD_SIZE // 3)
+
+
+async def _run_blocking(func, *args, **kwargs):
+    """Run a blocking service call on the upstream thread pool so the event loop stays free."""
+    async with _upstream_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_upstream_executor(), partial(func, *args, **kwargs))
+
+
+async def _run_upstream(coro):
+    """Await an async service call under the same upstream concurrency cap."""
+    async with _upstream_semaphore:
+        return await coro
+
+
+async def _read_upload(file: UploadFile) -> bytes:
+    """
+    Read an uploaded file in chunks, rejecting it as soon as it exceeds 10MB.
+    
+    Args:
+        file: Uploaded file
+    
+    Returns:
+        File contents
+    """
+    # The multipart parser records the spooled size, so a single read yields
+    # the final bytes object without the chunk buffer and its extra copy
+    if file.size is not None:
+        if file.size > _MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail="File too large. Maximum size: 10MB"
+            )
+        return await file.read()
+    
+    buffer = bytearray()
+    while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+        buffer.extend(chunk)
+        if len(buffer) > _MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail="File too large. Maximum size: 10MB"
+            )
+    return bytes(buffer)
+
+
+def _parse_prescription(extracted_data: dict) -> PrescriptionData:
+    """
+    Parse Gemini's extracted JSON into a PrescriptionData model.
+    
+    CPU-bound for long prescriptions, so callers run it in a worker thread.
+    
+    Args:
+        extracted_data: Raw dictionary returned by the OCR service
+    
+    Returns:
+        Validated PrescriptionData
+    """
+    # Parse doctor info
+    doctor_info = None
+    if "doctor_info" in extracted_data:
+        doctor_info = DoctorInfo.model_validate(extracted_data["doctor_info"])
+    
+    # Parse patient info
+    patient_info = None
+    if "patient_info" in extracted_data:
+        patient_info = PatientInfo.model_validate(extracted_data["patient_info"])
+    
+    # Parse medicines
+    medicines = []
+    if "medicines" in extracted_data:
+        for med in extracted_data["medicines"]:
+            # Normalize keys: "Medicine Name" -> "medicine_name", keeping only Medicine fields
+            normalized = {}
+            name_fallback = None
+            for key, value in med.items():
+                key_lower = key.lower().strip()
+                normalized_key = _MEDICINE_KEY_MAP.get(key_lower) or key_lower.replace(" ", "_")
+                if normalized_key in _MEDICINE_FIELDS:
+                    # All Medicine fields are strings; coerce numbers like 500 -> "500"
+                    if value is not None and not isinstance(value, str):
+                        value = str(value)
+                    normalized[normalized_key] = value
+                elif name_fallback is None and isinstance(value, str) and value and "name" in normalized_key:
+                    # Remember any other (string) key that looks like a name; the
+                    # value skips validation below, so non-strings are ignored
+                    name_fallback = value
+            
+            # Ensure medicine_name exists (required field)
+            if "medicine_name" not in normalized and name_fallback:
+                normalized["medicine_name"] = name_fallback
+            
+            if normalized.get("medicine_name"):
+                # Keys are filtered to Medicine fields and values are strings,
+                # so validation can be skipped; PrescriptionData still validates
+                medicines.append(Medicine.model_construct(**normalized))
+    
+    return PrescriptionData(
+        doctor_info=doctor_info,
+        patient_info=patient_info,
+        medicines=medicines
+    )
+
+
+def _normalize_role(role: str) -> str:
+    """Map a history role ("Assistant", "bot", "model", ...) to "user" or "assistant"."""
+    role = role.strip().lower()
+    role = _ROLE_ALIASES.get(role, role)
+    return role if role == "assistant" else "user"
+
+
+def _normalize_conversation_history(history: Optional[list]) -> List[Dict[str, str]]:
+    """
+    Normalize conversation history from ANY format to {role, content}.
+    
+    Args:
+        history: Raw history entries (strings, dicts, or objects)
+    
+    Returns:
+        List of {"role", "content"} dictionaries
+    """
+    conversation_history = []
+    for msg in (history or []):
+        if isinstance(msg, str):
+            # Handle string format: "User: Hi" or "Assistant: Hello..."
+            match = _ROLE_PREFIX_RE.match(msg)
+            if match:
+                conversation_history.append({"role": _normalize_role(match.group(1)), "content": match.group(2)})
+            else:
+                # Unknown format string, treat as user message
+                conversation_history.append({"role": "user", "content": msg.strip()})
+        
+        elif isinstance(msg, Mapping):
+            # Handle {role: "...", content: "..."} format (first non-empty alias wins)
+            role = next((msg[key] for key in _ROLE_KEYS if msg.get(key)), None)
+            content = next((msg[key] for key in _CONTENT_KEYS if msg.get(key)), None)
+            
+            if role and content:
+                conversation_history.append({"role": _normalize_role(str(role)), "content": content})
+            
+            # Handle {user: "...", bot: "..."} format (each key = separate message).
+            # Only used when there is no role/content pair, so a message isn't sent twice
+            else:
+                if msg.get("user"):
+                    conversation_history.append({"role": "user", "content": msg["user"]})
+                if msg.get("bot"):
+                    conversation_history.append({"role": "assistant", "content": msg["bot"]})
+        
+        else:
+            # Pydantic model or other object
+            conversation_history.append({
+                "role": _normalize_role(str(getattr(msg, 'role', 'user'))),
+                "content": getattr(msg, 'content', str(msg))
+            })
+    
+    return conversation_history
+
+
+def _sse_event(event: str, data: dict) -> bytes:
+    """Format one Server-Sent Event."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+async def _verify_doctor_registration(
+    doctor_verification_service: DoctorVerificationService,
+    doctor_name: str,
+    registration_no: str,
+    medical_council: Optional[str] = None
+) -> DoctorVerificationResponse:
+    """
+    Verify a doctor against the NMC registry and build the response model.
+    
+    Args:
+        doctor_verification_service: NMC verification service
+        doctor_name: Doctor's name from the prescription
+        registration_no: Doctor's registration number
+        medical_council: Optional medical council name
+    
+    Returns:
+        DoctorVerificationResponse with verification status and matching records
+    """
+    # Verify doctor using the verification service
+    verification_result = await _run_blocking(
+        doctor_verification_service.verify_doctor,
+        doctor_name=doctor_name,
+        registration_no=registration_no,
+        medical_council=medical_council
+    )
+    
+    # Convert to response model
+    matches = [NMCDoctorRecord.model_validate(match) for match in verification_result["matches"]]
+    best_match = None
+    if verification_result["best_match"]:
+        best_match = NMCDoctorRecord.model_validate(verification_result["best_match"])
+    
+    # Records are validated above and the remaining fields come straight from the service
+    return DoctorVerificationResponse.model_construct(
+        verified=verification_result["verified"],
+        reason=verification_result["reason"],
+        matches=matches,
+        best_match=best_match,
+        total_matches=verification_result["total_matches"]
+    )
+
 
+async def _check_medicines_safety(
+    medicine_safety_service: MedicineSafetyService,
+    medicines: List[str]
+) -> List[MedicineFlagResult]:
+    """
+    Check medicine names for safety, one result per requested name in request order.
+    
+    Args:
+        medicine_safety_service: Medicine safety check service
+        medicines: Medicine names to check
+    
+    Returns:
+        List of MedicineFlagResult
+    """
+    # The service de-duplicates names and answers in request order
+    results = await medicine_safety_service.check_medicines(medicines)
+    
+    # Convert to response model, counting flagged medicines in the same pass
+    flag_results = []
+    flagged_count = 0
+    for result in results:
+        flag_result = MedicineFlagResult.model_validate(result)
+        flag_results.append(flag_result)
+        flagged_count += flag_result.flagged
+    
+    logger.info("Safety check complete. Flagged: %d/%d", flagged_count, len(flag_results))
+    
+    return flag_results
 
 
 @router.post("/upload-prescription", response_model=OCRResponse)
-async def upload_prescription(file: UploadFile = File(...)):
+async def upload_prescription(
+    file: UploadFile = File(...),
+    gemini_service: GeminiOCRService = Depends(get_gemini_service)
+):
     """
     Upload a prescription document (PDF or image) and extract medicine details.
     
@@ -39,34 +333,21 @@ async def upload_prescription(file: UploadFile = File(...)):
         OCRResponse containing extracted prescription data
     """
     # Validate file type
-    allowed_types = [
-        "application/pdf",
-        "image/jpeg",
-        "image/jpg",
-        "image/png",
-    ]
-    
-    if file.content_type not in allowed_types:
+    if file.content_type not in _ALLOWED_MIME_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Invalid file type. Allowed types: PDF, JPEG, JPG, PNG. Got: {file.content_type}"
         )
     
     # Validate file size (max 10MB)
-    max_size = 10 * 1024 * 1024  # 10MB
-    file_bytes = await file.read()
-    
-    if len(file_bytes) > max_size:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size: 10MB. Got: {len(file_bytes) / (1024*1024):.2f}MB"
-        )
+    file_bytes = await _read_upload(file)
     
     try:
-        logger.info(f"Processing file: {file.filename}, type: {file.content_type}, size: {len(file_bytes)} bytes")
+        logger.info("Processing file: %s, type: %s, size: %d bytes", file.filename, file.content_type, len(file_bytes))
         
         # Extract prescription data using Gemini
-        extracted_data = gemini_service.extract_prescription_data(
+        extracted_data = await _run_blocking(
+            gemini_service.extract_prescription_data,
             file_bytes=file_bytes,
             mime_type=file.content_type
         )
@@ -82,69 +363,18 @@ async def upload_prescription(file: UploadFile = File(...)):
         
         # Parse the extracted data into structured models
         try:
-            # Parse doctor info
-            doctor_info = None
-            if "doctor_info" in extracted_data:
-                doctor_info = DoctorInfo(**extracted_data["doctor_info"])
-            
-            # Parse patient info
-            patient_info = None
-            if "patient_info" in extracted_data:
-                patient_info = PatientInfo(**extracted_data["patient_info"])
+            prescription_data = await asyncio.to_thread(_parse_prescription, extracted_data)
             
-            # Parse medicines
-            medicines = []
-            # Key mapping: Gemini may return various key formats
-            medicine_key_map = {
-                "medicine name": "medicine_name",
-                "medicine_name": "medicine_name",
-                "medicinename": "medicine_name",
-                "name": "medicine_name",
-                "dosage": "dosage",
-                "dosage amount": "dosage",
-                "dosage_instruction": "dosage_instruction",
-                "dosage instruction": "dosage_instruction",
-                "dosageinstruction": "dosage_instruction",
-                "frequency": "dosage_instruction",
-                "timing": "timing",
-                "duration": "duration",
-            }
+            logger.info("Successfully extracted %d medicines from prescription", len(prescription_data.medicines))
             
-            if "medicines" in extracted_data:
-                for med in extracted_data["medicines"]:
-                    # Normalize keys: "Medicine Name" -> "medicine_name"
-                    normalized = {}
-                    for key, value in med.items():
-                        normalized_key = medicine_key_map.get(key.lower().strip(), key.lower().replace(" ", "_"))
-                        normalized[normalized_key] = value
-                    
-                    # Ensure medicine_name exists (required field)
-                    if "medicine_name" not in normalized:
-                        # Try to find any key that looks like a name
-                        for k, v in normalized.items():
-                            if "name" in k and v:
-                                normalized["medicine_name"] = v
-                                break
-                    
-                    if "medicine_name" in normalized and normalized["medicine_name"]:
-                        medicines.append(Medicine(**{k: v for k, v in normalized.items() if k in Medicine.model_fields}))
-            
-            prescription_data = PrescriptionData(
-                doctor_info=doctor_info,
-                patient_info=patient_info,
-                medicines=medicines
-            )
-            
-            logger.info(f"Successfully extracted {len(medicines)} medicines from prescription")
-            
-            return OCRResponse(
+            return OCRResponse.model_construct(
                 success=True,
                 data=prescription_data,
                 error=None
             )
         
         except Exception as e:
-            logger.error(f"Error parsing extracted data: {str(e)}")
+            logger.error("Error parsing extracted data: %s", e)
             return OCRResponse(
                 success=False,
                 data=None,
@@ -153,11 +383,11 @@ async def upload_prescription(file: UploadFile = File(...)):
             )
     
     except ValueError as e:
-        logger.error(f"Validation error: {str(e)}")
+        logger.error("Validation error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+        logger.error("Unexpected error: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
@@ -167,7 +397,10 @@ async def upload_prescription(file: UploadFile = File(...)):
 
 
 @router.post("/verify-doctor", response_model=DoctorVerificationResponse)
-async def verify_doctor(request: VerifyDoctorRequest):
+async def verify_doctor(
+    request: VerifyDoctorRequest,
+    doctor_verification_service: DoctorVerificationService = Depends(get_doctor_verification_service)
+):
     """
     Verify a doctor's credentials against the National Medical Council (NMC) registry.
     
@@ -178,35 +411,21 @@ async def verify_doctor(request: VerifyDoctorRequest):
         DoctorVerificationResponse with verification status and matching records
     """
     try:
-        logger.info(f"Verifying doctor: {request.doctor_name}, Reg No: {request.registration_number}")
+        logger.info("Verifying doctor: %s, Reg No: %s", request.doctor_name, request.registration_number)
         
-        # Verify doctor using the verification service
-        verification_result = doctor_verification_service.verify_doctor(
+        response = await _verify_doctor_registration(
+            doctor_verification_service,
             doctor_name=request.doctor_name,
             registration_no=request.registration_number,
             medical_council=request.medical_council
         )
         
-        # Convert to response model
-        matches = [NMCDoctorRecord(**match) for match in verification_result["matches"]]
-        best_match = None
-        if verification_result["best_match"]:
-            best_match = NMCDoctorRecord(**verification_result["best_match"])
-        
-        response = DoctorVerificationResponse(
-            verified=verification_result["verified"],
-            reason=verification_result["reason"],
-            matches=matches,
-            best_match=best_match,
-            total_matches=verification_result["total_matches"]
-        )
-        
-        logger.info(f"Verification result: {response.verified}, Matches: {response.total_matches}")
+        logger.info("Verification result: %s, Matches: %s", response.verified, response.total_matches)
         
         return response
     
     except Exception as e:
-        logger.error(f"Error verifying doctor: {str(e)}", exc_info=True)
+        logger.error("Error verifying doctor: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=f"Error verifying doctor: {str(e)}"
@@ -216,14 +435,14 @@ async def verify_doctor(request: VerifyDoctorRequest):
 @router.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {
-        "status": "healthy",
-        "message": "Medicine Verification Service is running"
-    }
+    return Response(content=_HEALTH_BODY, media_type="application/json", headers=_HEALTH_HEADERS)
 
 
 @router.post("/check-medicine-safety", response_model=MedicineSafetyResponse)
-async def check_medicine_safety(request: MedicineSafetyRequest):
+async def check_medicine_safety(
+    request: MedicineSafetyRequest,
+    medicine_safety_service: MedicineSafetyService = Depends(get_medicine_safety_service)
+):
     """
     Check if medicines are safe (not banned, restricted, or withdrawn in India).
     
@@ -234,7 +453,7 @@ async def check_medicine_safety(request: MedicineSafetyRequest):
         MedicineSafetyResponse with safety status for each medicine
     """
     try:
-        logger.info(f"Checking safety for {len(request.medicines)} medicines")
+        logger.info("Checking safety for %d medicines", len(request.medicines))
         
         if not request.medicines:
             return MedicineSafetyResponse(
@@ -243,22 +462,16 @@ async def check_medicine_safety(request: MedicineSafetyRequest):
                 error="No medicines provided"
             )
         
-        # Check medicines using the safety service
-        results = medicine_safety_service.check_medicines(request.medicines)
-        
-        # Convert to response model
-        flag_results = [MedicineFlagResult(**result) for result in results]
+        flag_results = await _check_medicines_safety(medicine_safety_service, request.medicines)
         
-        logger.info(f"Safety check complete. Flagged: {sum(1 for r in flag_results if r.flagged)}/{len(flag_results)}")
-        
-        return MedicineSafetyResponse(
+        return MedicineSafetyResponse.model_construct(
             success=True,
             results=flag_results,
             error=None
         )
     
     except Exception as e:
-        logger.error(f"Error checking medicine safety: {str(e)}", exc_info=True)
+        logger.error("Error checking medicine safety: %s", e, exc_info=True)
         return MedicineSafetyResponse(
             success=False,
             results=None,
@@ -266,8 +479,90 @@ async def check_medicine_safety(request: MedicineSafetyRequest):
         )
 
 
+@router.post("/validate-prescription", response_model=PrescriptionValidationResponse)
+async def validate_prescription(
+    file: UploadFile = File(...),
+    gemini_service: GeminiOCRService = Depends(get_gemini_service),
+    doctor_verification_service: DoctorVerificationService = Depends(get_doctor_verification_service),
+    medicine_safety_service: MedicineSafetyService = Depends(get_medicine_safety_service)
+):
+    """
+    Upload a prescription, then verify its doctor and check its medicines in one call.
+    
+    Runs OCR first, then the NMC doctor verification and the medicine safety check
+    concurrently, so the total latency is OCR + max(verification, safety check)
+    and the client saves two round-trips.
+    
+    Args:
+        file: Uploaded file (PDF, JPG, JPEG, PNG)
+    
+    Returns:
+        PrescriptionValidationResponse with extracted data, doctor verification
+        and per-medicine safety results
+    """
+    # Validate file type
+    if file.content_type not in _ALLOWED_MIME_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: PDF, JPEG, JPG, PNG. Got: {file.content_type}"
+        )
+    
+    # Validate file size (max 10MB)
+    file_bytes = await _read_upload(file)
+    
+    try:
+        logger.info("Validating prescription: %s, type: %s, size: %d bytes", file.filename, file.content_type, len(file_bytes))
+        
+        extracted_data = await _run_blocking(
+            gemini_service.extract_prescription_data,
+            file_bytes=file_bytes,
+            mime_type=file.content_type
+        )
+        
+        if "error" in extracted_data:
+            return PrescriptionValidationResponse(
+                success=False,
+                error=extracted_data.get("error"),
+                raw_response=extracted_data.get("raw_response")
+            )
+        
+        prescription_data = await asyncio.to_thread(_parse_prescription, extracted_data)
+        doctor_info = prescription_data.doctor_info or DoctorInfo()
+        
+        # Verification and safety check are independent, so run them side by side
+        doctor_verification, medicine_safety = await asyncio.gather(
+            _verify_doctor_registration(
+                doctor_verification_service,
+                doctor_name=doctor_info.doctor_name or "",
+                registration_no=doctor_info.registration_number or ""
+            ),
+            _check_medicines_safety(
+                medicine_safety_service,
+                [medicine.medicine_name for medicine in prescription_data.medicines]
+            )
+        )
+        
+        return PrescriptionValidationResponse.model_construct(
+            success=True,
+            data=prescription_data,
+            doctor_verification=doctor_verification,
+            medicine_safety=medicine_safety,
+            error=None
+        )
+    
+    except Exception as e:
+        logger.error("Error validating prescription: %s", e, exc_info=True)
+        return PrescriptionValidationResponse(
+            success=False,
+            error=f"Error validating prescription: {str(e)}"
+        )
+
+
 @router.post("/medical-chat", response_model=MedicalChatResponse)
-async def medical_chat(request: MedicalChatRequest):
+async def medical_chat(
+    request: MedicalChatRequest,
+    medical_chat_service: MedicalChatService = Depends(get_medical_chat_service)
+):
     """
     Chat with AI assistant to collect medical symptoms and medication information.
     
@@ -290,19 +585,21 @@ async def medical_chat(request: MedicalChatRequest):
     """
     try:
         # Log request details for debugging
-        logger.info("="*60)
+        # Lazy %-formatting: nothing below is rendered unless INFO logging is enabled
+        logger.info("=" * 60)
         logger.info("MEDICAL CHAT REQUEST RECEIVED")
-        logger.info(f"  message: {str(request.message)[:10] if request.message else 'None'}...")
-        logger.info(f"  audio_base64: {str(request.audio_base64)[:10] if request.audio_base64 else 'None'}...")
-        logger.info(f"  conversation_history: {len(request.conversation_history)} messages")
-        logger.info(f"  medical_information: {request.medical_information}")
-        logger.info(f"  prescription_data: {'Present' if request.prescription_data else 'None'}")
-        logger.info("="*60)
+        logger.info("  message: %.10s...", request.message or "None")
+        logger.info("  audio_base64: %.10s...", request.audio_base64 or "None")
+        logger.info("  conversation_history: %d messages", len(request.conversation_history or []))
+        logger.info("  medical_information: %s", request.medical_information)
+        logger.info("  prescription_data: %s", "Present" if request.prescription_data else "None")
+        logger.info("=" * 60)
         
         # Determine if audio or text input
-        input_type = "audio" if request.audio_base64 else "text"
-        log_message = f"audio input ({len(request.audio_base64) if request.audio_base64 else 0} bytes)" if input_type == "audio" else f"text: {request.message[:50] if request.message else 'empty'}..."
-        logger.info(f"Processing medical chat - {log_message}")
+        if request.audio_base64:
+            logger.info("Processing medical chat - audio input (%d bytes)", len(request.audio_base64))
+        else:
+            logger.info("Processing medical chat - text: %.50s...", request.message or "empty")
         
         # Validate input
         if not request.message and not request.audio_base64:
@@ -315,41 +612,8 @@ async def medical_chat(request: MedicalChatRequest):
                 error="Either 'message' or 'audio_base64' must be provided"
             )
         
-        # Normalize conversation history from ANY format to {role, content}
-        conversation_history = []
-        for msg in (request.conversation_history or []):
-            if isinstance(msg, str):
-                # Handle string format: "User: Hi" or "Assistant: Hello..."
-                msg_lower = msg.strip()
-                if msg_lower.lower().startswith("user:"):
-                    conversation_history.append({"role": "user", "content": msg_lower[5:].strip()})
-                elif msg_lower.lower().startswith("assistant:"):
-                    conversation_history.append({"role": "assistant", "content": msg_lower[10:].strip()})
-                elif msg_lower.lower().startswith("bot:"):
-                    conversation_history.append({"role": "assistant", "content": msg_lower[4:].strip()})
-                else:
-                    # Unknown format string, treat as user message
-                    conversation_history.append({"role": "user", "content": msg_lower})
-            
-            elif isinstance(msg, dict):
-                # Handle {role: "...", content: "..."} format
-                role = msg.get("role") or msg.get("sender") or None
-                content = msg.get("content") or msg.get("text") or msg.get("message") or None
-                
-                if role and content:
-                    conversation_history.append({"role": role, "content": content})
-                
-                # Handle {user: "...", bot: "..."} format (each key = separate message)
-                if "user" in msg and msg["user"]:
-                    conversation_history.append({"role": "user", "content": msg["user"]})
-                if "bot" in msg and msg["bot"]:
-                    conversation_history.append({"role": "assistant", "content": msg["bot"]})
-            
-            else:
-                # Pydantic model or other object
-                conversation_history.append({"role": getattr(msg, 'role', 'user'), "content": getattr(msg, 'content', str(msg))})
-        
-        logger.info(f"  Normalized conversation_history: {len(conversation_history)} messages")
+        conversation_history = _normalize_conversation_history(request.conversation_history)
+        logger.info("  Normalized conversation_history: %d messages", len(conversation_history))
         
         # Medical information is now a raw dict, pass directly
         medical_info = request.medical_information
@@ -358,19 +622,19 @@ async def medical_chat(request: MedicalChatRequest):
         prescription_data = request.prescription_data
         
         # Process the chat with audio support
-        result = medical_chat_service.chat(
+        result = await _run_upstream(medical_chat_service.chat(
             user_message=request.message,
-            audio_base64=request.audio_base64,
+            audio_bytes=_decode_audio_base64(request.audio_base64),
             conversation_history=conversation_history,
             medical_information=medical_info,
             prescription_data=prescription_data,
             return_audio=True  # Always generate audio response
-        )
+        ))
         
         # Get updated medical information (already a dict)
         updated_medical_info = result.get("updated_medical_information")
         
-        logger.info(f"Chat response generated. Complete: {result.get('conversation_complete', False)}")
+        logger.info("Chat response generated. Complete: %s", result.get("conversation_complete", False))
         
         return MedicalChatResponse(
             success=True,
@@ -382,7 +646,7 @@ async def medical_chat(request: MedicalChatRequest):
         )
     
     except Exception as e:
-        logger.error(f"Error in medical chat: {str(e)}", exc_info=True)
+        logger.error("Error in medical chat: %s", e, exc_info=True)
         return MedicalChatResponse(
             success=False,
             response=None,
@@ -393,3 +657,178 @@ async def medical_chat(request: MedicalChatRequest):
         )
 
 
+@router.post("/medical-chat/stream")
+async def medical_chat_stream(
+    request: MedicalChatRequest,
+    medical_chat_service: MedicalChatService = Depends(get_medical_chat_service)
+):
+    """
+    Streaming variant of /medical-chat using Server-Sent Events.
+    
+    The text reply is sent as soon as the LLM finishes, so clients can show it
+    while speech synthesis is still running. Events, in order:
+    - 'response': response, updated_medical_information, conversation_complete
+    - 'audio': audio_response_base64 (base64 encoded WAV, null if TTS failed)
+    - 'error': error (sent instead of the above if the chat fails)
+    
+    Args:
+        request: Same body as /medical-chat
+    
+    Returns:
+        StreamingResponse with media type text/event-stream
+    """
+    async def events():
+        if not request.message and not request.audio_base64:
+            yield _sse_event("error", {"error": "Either 'message' or 'audio_base64' must be provided"})
+            return
+        
+        try:
+            result = await _run_upstream(medical_chat_service.chat(
+                user_message=request.message,
+                audio_bytes=_decode_audio_base64(request.audio_base64),
+                conversation_history=_normalize_conversation_history(request.conversation_history),
+                medical_information=request.medical_information,
+                prescription_data=request.prescription_data,
+                return_audio=False
+            ))
+            yield _sse_event("response", {
+                "response": result.get("response"),
+                "updated_medical_information": result.get("updated_medical_information"),
+                "conversation_complete": result.get("conversation_complete", False)
+            })
+            
+            audio_response_base64 = await _run_upstream(
+                medical_chat_service.generate_audio_response(result.get("response"))
+            )
+            yield _sse_event("audio", {"audio_response_base64": audio_response_base64})
+        
+        except Exception as e:
+            logger.error("Error in medical chat stream: %s", e, exc_info=True)
+            yield _sse_event("error", {"error": f"Error in medical chat: {str(e)}"})
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _decode_audio_base64(audio_base64: Optional[str]) -> Optional[bytes]:
+    """
+    Decode the chat request's audio once, at the route boundary.
+    
+    Args:
+        audio_base64: Base64-encoded audio from the request body
+    
+    Returns:
+        Raw audio bytes, or None if no audio was sent
+    """
+    if not audio_base64:
+        return None
+    if len(audio_base64) > _MAX_AUDIO_BASE64_LENGTH:
+        raise ValueError("Audio too large. Maximum size: 10MB")
+    try:
+        # Line-wrapped base64 (MIME encoders, shell `base64`) is still accepted
+        return base64.b64decode("".join(audio_base64.split()), validate=True)
+    except binascii.Error as e:
+        raise ValueError(f"'audio_base64' is not valid base64: {str(e)}")
+
+
+def _parse_json_form_field(value: Optional[str], name: str):
+    """Decode a JSON-encoded multipart form field."""
+    if not value:
+        return None
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"'{name}' must be valid JSON: {str(e)}")
+
+
+@router.post("/medical-chat/voice", response_model=MedicalChatResponse)
+async def medical_chat_voice(
+    audio: Optional[UploadFile] = File(None),
+    message: Optional[str] = Form(None),
+    conversation_history: Optional[str] = Form(None),
+    medical_information: Optional[str] = Form(None),
+    prescription_data: Optional[str] = Form(None),
+    medical_chat_service: MedicalChatService = Depends(get_medical_chat_service)
+):
+    """
+    Voice variant of /medical-chat that exchanges raw audio instead of base64.
+    
+    Send a multipart form with the recording in 'audio' (or text in 'message');
+    'conversation_history', 'medical_information' and 'prescription_data' are
+    JSON-encoded form fields with the same shape as in /medical-chat. The spoken
+    reply is returned as 'audio_url', a short-lived link to a WAV file served by
+    GET /medical-chat/audio/{audio_id}.
+    
+    Args:
+        audio: Recorded user message (any common audio format)
+        message: User's message as text
+        conversation_history: JSON list of previous messages
+        medical_information: JSON object of collected medical information
+        prescription_data: JSON object of prescription data from OCR
+    
+    Returns:
+        MedicalChatResponse with 'audio_url' instead of 'audio_response_base64'
+    """
+    try:
+        audio_bytes = await _read_upload(audio) if audio is not None else None
+        
+        if not message and not audio_bytes:
+            return MedicalChatResponse(
+                success=False,
+                error="Either 'message' or 'audio' must be provided"
+            )
+        
+        result = await _run_upstream(medical_chat_service.chat(
+            user_message=message,
+            audio_bytes=audio_bytes,
+            conversation_history=_normalize_conversation_history(
+                _parse_json_form_field(conversation_history, "conversation_history")
+            ),
+            medical_information=_parse_json_form_field(medical_information, "medical_information"),
+            prescription_data=_parse_json_form_field(prescription_data, "prescription_data"),
+            return_audio=False
+        ))
+        
+        audio_url = None
+        wav_data = await _run_upstream(medical_chat_service.generate_audio_wav(result.get("response")))
+        if wav_data is not None:
+            audio_id = medical_chat_service.store_audio_clip(wav_data)
+            audio_url = f"{router.prefix}/medical-chat/audio/{audio_id}"
+        
+        return MedicalChatResponse(
+            success=True,
+            response=result.get("response"),
+            audio_url=audio_url,
+            updated_medical_information=result.get("updated_medical_information"),
+            conversation_complete=result.get("conversation_complete", False),
+            error=None
+        )
+    
+    except HTTPException:
+        raise
+    
+    except Exception as e:
+        logger.error("Error in medical voice chat: %s", e, exc_info=True)
+        return MedicalChatResponse(
+            success=False,
+            error=f"Error in medical chat: {str(e)}"
+        )
+
+
+@router.get("/medical-chat/audio/{audio_id}")
+async def get_medical_chat_audio(
+    audio_id: str,
+    medical_chat_service: MedicalChatService = Depends(get_medical_chat_service)
+):
+    """
+    Download a spoken reply generated by /medical-chat/voice.
+    
+    Args:
+        audio_id: ID from the 'audio_url' of a voice chat response
+    
+    Returns:
+        WAV audio
+    """
+    wav_data = medical_chat_service.get_audio_clip(audio_id)
+    if wav_data is None:
+        raise HTTPException(status_code=404, detail="Audio not found or expired")
+    return Response(content=wav_data, media_type="audio/wav")
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 
 
@@ -95,6 +95,16 @@ class MedicineSafetyResponse(BaseModel):
     error: Optional[str] = Field(None, description="Error message if check failed")
 
 
+class PrescriptionValidationResponse(BaseModel):
+    """Response model for combined prescription validation (OCR + doctor + medicine safety)."""
+    success: bool = Field(..., description="Whether the validation was successful")
+    data: Optional[PrescriptionData] = Field(None, description="Extracted prescription data")
+    doctor_verification: Optional[DoctorVerificationResponse] = Field(None, description="NMC verification of the prescribing doctor")
+    medicine_safety: Optional[List[MedicineFlagResult]] = Field(None, description="Safety check results for each prescribed medicine")
+    error: Optional[str] = Field(None, description="Error message if validation failed")
+    raw_response: Optional[str] = Field(None, description="Raw response from Gemini (for debugging)")
+
+
 # Medical Chat Schemas
 class ChatMessage(BaseModel):
     """Individual chat message. Accepts multiple key formats."""
@@ -106,8 +116,7 @@ class ChatMessage(BaseModel):
     sender: Optional[str] = Field(None, description="Sender role (alternative key)")
     text: Optional[str] = Field(None, description="Message text (alternative key)")
 
-    class Config:
-        extra = "allow"  # Allow any extra fields without failing
+    model_config = ConfigDict(extra="allow")  # Allow any extra fields without failing
 
 
 class MedicalInformation(BaseModel):
@@ -116,8 +125,7 @@ class MedicalInformation(BaseModel):
     medications_provided_by_user: Optional[List[str]] = Field(None, description="Medications listed by user")
     medication_confirmation: Optional[bool] = Field(None, description="Whether user confirmed medications")
 
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class MedicalChatRequest(BaseModel):
@@ -134,6 +142,7 @@ class MedicalChatResponse(BaseModel):
     success: bool = Field(..., description="Whether the chat was successful")
     response: Optional[str] = Field(None, description="AI assistant's response (text)")
     audio_response_base64: Optional[str] = Field(None, description="AI assistant's response (audio as base64)")
+    audio_url: Optional[str] = Field(None, description="URL of the AI assistant's response as a WAV file (voice endpoint)")
     updated_medical_information: Optional[dict] = Field(None, description="Updated medical information")
     conversation_complete: bool = Field(False, description="Whether the conversation flow is complete")
     error: Optional[str] = Field(None, description="Error message if chat failed")
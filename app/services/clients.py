@@ -0,0 +1,71 @@
+import os
+import httpx
+import requests
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google import genai
+from google.genai import types
+
+# Keep-alive pool size shared by every upstream connection pool
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "100"))
+
+# Upper bound on a single Gemini request; OCR with high thinking can take a while
+GEMINI_TIMEOUT_MS = int(os.environ.get("GEMINI_TIMEOUT_MS", "120000"))
+
+
+def create_genai_client(api_key: Optional[str] = None) -> genai.Client:
+    """
+    Create a Gemini client backed by a pooled keep-alive HTTP connection.
+
+    A single client is meant to be shared by all Gemini-backed services so
+    TCP/TLS setup is paid once per process instead of once per service.
+
+    Args:
+        api_key: Gemini API key (defaults to GEMINI_API_KEY / GOOGLEAPIKEY)
+
+    Returns:
+        Configured genai.Client
+    """
+    api_key = api_key or os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLEAPIKEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY or GOOGLEAPIKEY environment variable must be set")
+
+    # HTTP/2 multiplexes concurrent Gemini calls over a few connections
+    # (httpx already negotiates gzip/deflate response compression by default)
+    client_args = {
+        "limits": httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE
+        ),
+        "http2": True,
+    }
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            timeout=GEMINI_TIMEOUT_MS,
+            client_args=client_args,
+            async_client_args=client_args,
+        ),
+    )
+
+
+def create_nmc_session() -> requests.Session:
+    """
+    Create a requests session with a keep-alive pool for the NMC registry.
+
+    Transient gateway errors are retried on the pooled connection with a short
+    backoff instead of failing the verification outright.
+
+    Returns:
+        Configured requests.Session
+    """
+    retries = Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET"})
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retries))
+    return session
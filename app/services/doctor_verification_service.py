@@ -1,15 +1,31 @@
+import os
 import requests
 import urllib3
 import re
+import sqlite3
+import threading
+import time
+import orjson
 from typing import List, Dict, Optional
-from difflib import SequenceMatcher
 import logging
+from operator import itemgetter
+from cachetools import TTLCache
+from rapidfuzz import fuzz, process
+from app.services.clients import create_nmc_session
 
 # Disable SSL warnings for government certificate issues
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 logger = logging.getLogger(__name__)
 
+# Titles and punctuation ignored when comparing doctor names
+_TITLES = frozenset({"dr", "mr", "mrs", "miss", "ms"})
+_PUNCT_RE = re.compile(r"[.,()]")
+
+# Columns of an NMC DataTables row, and the doctor ID inside its details link
+_ROW_FIELDS = itemgetter(0, 1, 2, 3, 4, 5, 6)
+_DOCTOR_ID_RE = re.compile(r"openDoctorDetailsnew\('(\d+)'")
+
 
 class DoctorVerificationService:
     """Service for verifying doctor credentials against NMC registry."""
@@ -20,17 +36,92 @@ class DoctorVerificationService:
         "User-Agent": "Mozilla/5.0",
         "Referer": "https://www.nmc.org.in/information-desk/indian-medical-register/",
         "Accept": "application/json, text/javascript, */*; q=0.01",
-        "X-Requested-With": "XMLHttpRequest"
+        "X-Requested-With": "XMLHttpRequest",
+        "Accept-Encoding": "gzip, deflate"
     }
     
-    def __init__(self, similarity_threshold: float = 0.2):
+    def __init__(
+        self,
+        similarity_threshold: float = 0.2,
+        session: Optional[requests.Session] = None,
+        cache_ttl: int = 3600,
+        cache_maxsize: int = 10_000,
+        unknown_ttl: int = 900,
+        store_path: Optional[str] = None,
+        store_ttl: int = 7 * 86400
+    ):
         """
         Initialize the doctor verification service.
         
         Args:
             similarity_threshold: Minimum similarity score (0-1) for name matching
+            session: Shared HTTP session (a pooled one is created if omitted)
+            cache_ttl: Seconds a verification result (or the NMC records for a
+                registration number) is reused
+            cache_maxsize: Maximum number of cached verification results and
+                registry lookups
+            unknown_ttl: Seconds a registration number with no NMC records is
+                rejected without querying NMC again
+            store_path: Optional SQLite file that keeps NMC records across restarts
+                and shares them between workers (defaults to NMC_CACHE_PATH)
+            store_ttl: Seconds a persisted NMC record is trusted
         """
         self.similarity_threshold = similarity_threshold
+        self._threshold_pct = similarity_threshold * 100
+        self.session = session or create_nmc_session()
+        # Set once on the pooled session instead of being merged into every request
+        self.session.headers.update(self.HEADERS)
+        self._result_cache = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl)
+        self._registry_cache = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl)
+        self._unknown_registrations = TTLCache(maxsize=cache_maxsize, ttl=unknown_ttl)
+        self._cache_lock = threading.Lock()
+        self._store_ttl = store_ttl
+        self._store = self._open_store(store_path or os.environ.get("NMC_CACHE_PATH"))
+    
+    @staticmethod
+    def _open_store(path: Optional[str]) -> Optional[sqlite3.Connection]:
+        """
+        Open (creating if needed) the persistent NMC record store.
+        
+        Args:
+            path: SQLite database file, or None to disable persistence
+            
+        Returns:
+            SQLite connection, or None if persistence is disabled
+        """
+        if not path:
+            return None
+        
+        # Autocommit + WAL so several uvicorn workers can share one file
+        store = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        store.execute("PRAGMA journal_mode=WAL")
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS nmc_records ("
+            "registration_no TEXT PRIMARY KEY, records BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        logger.info("Persisting NMC records to %s", path)
+        return store
+    
+    def _load_stored_records(self, registry_key: str) -> Optional[List[Dict]]:
+        """Persisted NMC records for a registration number, if present and fresh."""
+        if self._store is None:
+            return None
+        with self._cache_lock:
+            row = self._store.execute(
+                "SELECT records FROM nmc_records WHERE registration_no = ? AND expires_at > ?",
+                (registry_key, time.time())
+            ).fetchone()
+        return orjson.loads(row[0]) if row else None
+    
+    def _save_stored_records(self, registry_key: str, doctors: List[Dict]):
+        """Persist NMC records for a registration number."""
+        if self._store is None:
+            return
+        with self._cache_lock:
+            self._store.execute(
+                "INSERT OR REPLACE INTO nmc_records VALUES (?, ?, ?)",
+                (registry_key, orjson.dumps(doctors), time.time() + self._store_ttl)
+            )
     
     def _build_params(self, registration_no: str) -> dict:
         """Build request parameters for NMC API."""
@@ -57,49 +148,34 @@ class DoctorVerificationService:
         Returns:
             Dictionary with parsed doctor information
         """
-        doctor_id = None
-        if row[6]:
-            match = re.search(r"openDoctorDetailsnew\('(\d+)'", row[6])
-            if match:
-                doctor_id = match.group(1)
+        serial_no, year, reg_no, council, name, relative, details_link = _ROW_FIELDS(row)
+        match = _DOCTOR_ID_RE.search(details_link) if details_link else None
         
         return {
-            "serial_no": row[0],
-            "registration_year": row[1],
-            "registration_number": row[2],
-            "medical_council": row[3],
-            "doctor_name": row[4],
-            "father_or_spouse_name": row[5],
-            "doctor_id": doctor_id
+            "serial_no": serial_no,
+            "registration_year": year,
+            "registration_number": reg_no,
+            "medical_council": council,
+            "doctor_name": name,
+            "father_or_spouse_name": relative,
+            "doctor_id": match.group(1) if match else None
         }
     
-    def _calculate_name_similarity(self, name1: str, name2: str) -> float:
+    @staticmethod
+    def _normalize_name(name: Optional[str]) -> str:
         """
-        Calculate similarity between two names using SequenceMatcher.
+        Normalize a name for comparison: lowercase, drop punctuation and titles.
         
         Args:
-            name1: First name to compare
-            name2: Second name to compare
+            name: Name to normalize
             
         Returns:
-            Similarity score between 0 and 1
+            Normalized name
         """
-        # Normalize names: lowercase, remove extra spaces, remove common titles
-        def normalize(name):
-            if not name:
-                return ""
-            name = name.lower()
-            # Remove common titles and punctuation
-            titles = ['dr', 'dr.', 'mr', 'mr.', 'mrs', 'mrs.', 'miss', 'ms', 'ms.']
-            words = name.split()
-            words = [w.strip('.,()') for w in words if w.strip('.,()') not in titles]
-            return ' '.join(words)
-        
-        norm_name1 = normalize(name1)
-        norm_name2 = normalize(name2)
-        
-        # Calculate similarity
-        return SequenceMatcher(None, norm_name1, norm_name2).ratio()
+        if not name:
+            return ""
+        words = _PUNCT_RE.sub(" ", name.lower()).split()
+        return " ".join(w for w in words if w not in _TITLES)
     
     def fetch_doctors_by_registration(self, registration_no: str) -> List[Dict]:
         """
@@ -111,42 +187,85 @@ class DoctorVerificationService:
         Returns:
             List of doctor records from NMC
         """
+        doctors = self._query_nmc(registration_no)
+        return doctors if doctors is not None else []
+    
+    def _query_nmc(self, registration_no: str) -> Optional[List[Dict]]:
+        """
+        Query the NMC registry for a registration number.
+        
+        Args:
+            registration_no: Doctor's registration number
+            
+        Returns:
+            List of doctor records, or None if the registry could not be queried
+        """
+        # Records are cached per registration number, so lookups of the same
+        # number under different name spellings share one NMC round-trip
+        registry_key = registration_no.strip()
+        with self._cache_lock:
+            cached = self._registry_cache.get(registry_key)
+        if cached is not None:
+            return cached
+        
+        # The registry changes rarely, so records persisted by any worker are reused
+        stored = self._load_stored_records(registry_key)
+        if stored is not None:
+            with self._cache_lock:
+                self._registry_cache[registry_key] = stored
+            return stored
+        
         try:
-            logger.info(f"Fetching doctors with registration number: {registration_no}")
+            logger.info("Fetching doctors with registration number: %s", registration_no)
             
-            response = requests.get(
+            response = self.session.get(
                 self.NMC_URL,
                 params=self._build_params(registration_no),
-                headers=self.HEADERS,
                 verify=False,
                 timeout=15
             )
             
-            logger.info(f"NMC API response status: {response.status_code}")
+            logger.info("NMC API response status: %s", response.status_code)
             
             if response.status_code != 200:
-                logger.error(f"NMC API returned status {response.status_code}")
-                return []
+                logger.error("NMC API returned status %s", response.status_code)
+                return None
             
             # Validate JSON response
             if not response.headers.get("Content-Type", "").startswith("application/json"):
                 logger.error("NMC API response is not JSON")
-                return []
+                return None
             
             data = response.json()
             raw_rows = data.get("data", [])
             
             doctors = [self._parse_doctor_row(row) for row in raw_rows]
-            logger.info(f"Found {len(doctors)} doctor(s) with registration number {registration_no}")
+            logger.info("Found %d doctor(s) with registration number %s", len(doctors), registration_no)
+            
+            if doctors:
+                with self._cache_lock:
+                    self._registry_cache[registry_key] = doctors
+                self._save_stored_records(registry_key, doctors)
             
             return doctors
             
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching from NMC API: {str(e)}")
-            return []
+            logger.error("Error fetching from NMC API: %s", e)
+            return None
         except Exception as e:
-            logger.error(f"Unexpected error in fetch_doctors_by_registration: {str(e)}")
-            return []
+            logger.error("Unexpected error in fetch_doctors_by_registration: %s", e)
+            return None
+    
+    @staticmethod
+    def _not_found_result(registration_no: str) -> dict:
+        """Verification result for a registration number with no NMC records."""
+        return {
+            "verified": False,
+            "reason": f"No doctors found with registration number {registration_no}",
+            "matches": [],
+            "best_match": None,
+            "total_matches": 0
+        }
     
     def verify_doctor(
         self, 
@@ -170,52 +289,79 @@ class DoctorVerificationService:
                 "verified": False,
                 "reason": "No registration number provided",
                 "matches": [],
-                "best_match": None
+                "best_match": None,
+                "total_matches": 0
             }
         
+        # Registration numbers NMC recently reported as unknown are rejected without a lookup
+        with self._cache_lock:
+            known_unknown = registration_no.strip() in self._unknown_registrations
+        if known_unknown:
+            return self._not_found_result(registration_no)
+        
+        # A doctor writes many prescriptions, so reuse recent results for the same lookup
+        cache_key = (
+            (doctor_name or "").lower().strip(),
+            registration_no.strip(),
+            (medical_council or "").lower().strip()
+        )
+        with self._cache_lock:
+            cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached verification for registration number: %s", registration_no)
+            return cached
+        
         # Fetch doctors from NMC
-        nmc_doctors = self.fetch_doctors_by_registration(registration_no)
+        nmc_doctors = self._query_nmc(registration_no)
         
         if not nmc_doctors:
-            return {
-                "verified": False,
-                "reason": f"No doctors found with registration number {registration_no}",
-                "matches": [],
-                "best_match": None
-            }
+            if nmc_doctors is not None:
+                # NMC answered with no records (not an outage): remember the miss
+                with self._cache_lock:
+                    self._unknown_registrations[registration_no.strip()] = True
+            return self._not_found_result(registration_no)
         
-        # Calculate similarity scores for all matches
-        matches_with_scores = []
-        for doctor in nmc_doctors:
-            similarity = self._calculate_name_similarity(doctor_name, doctor["doctor_name"])
-            matches_with_scores.append({
-                **doctor,
-                "name_similarity": round(similarity, 3)
-            })
-        
-        # Sort by similarity score
-        matches_with_scores.sort(key=lambda x: x["name_similarity"], reverse=True)
+        # Score all matches in one C++ call, which also returns them best-first
+        # (the query name is normalized once)
+        scored = process.extract(
+            self._normalize_name(doctor_name),
+            [self._normalize_name(doctor["doctor_name"]) for doctor in nmc_doctors],
+            scorer=fuzz.ratio,
+            limit=None
+        )
+        matches_with_scores = [
+            {**nmc_doctors[index], "name_similarity": round(score / 100.0, 3)}
+            for _, score, index in scored
+        ]
         
         best_match = matches_with_scores[0] if matches_with_scores else None
+        # RapidFuzz scores are already percentages, so decide and report on those directly
+        best_score = scored[0][1] if scored else None
         
         # Determine if verified
         verified = False
         reason = ""
         
-        if best_match and best_match["name_similarity"] >= self.similarity_threshold:
+        if best_match and best_score >= self._threshold_pct:
             verified = True
-            reason = f"Doctor verified with {best_match['name_similarity']*100:.1f}% name match"
+            reason = f"Doctor verified with {best_score:.1f}% name match"
         elif best_match:
             verified = False
-            reason = f"Name similarity too low ({best_match['name_similarity']*100:.1f}%). Possible match found but requires manual verification."
+            reason = f"Name similarity too low ({best_score:.1f}%). Possible match found but requires manual verification."
         else:
             verified = False
             reason = "No matching doctor found"
         
-        return {
+        result = {
             "verified": verified,
             "reason": reason,
             "matches": matches_with_scores,
             "best_match": best_match,
             "total_matches": len(matches_with_scores)
         }
+        
+        # Only successful registry lookups are cached, so NMC outages are retried
+        with self._cache_lock:
+            self._result_cache[cache_key] = result
+        
+        return result
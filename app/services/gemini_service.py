@@ -1,35 +1,91 @@
-import os
-import base64
+import hashlib
 import io
+import re
+import tempfile
+import threading
+import orjson
 from typing import Optional
+from cachetools import TTLCache
 from PIL import Image
-from PyPDF2 import PdfReader
-from pdf2image import convert_from_bytes
 from google import genai
 from google.genai import types
+from app.services.clients import create_genai_client
+
+# Body of a markdown code block (```json ... ```), tolerating a missing closing fence
+_CODE_FENCE_RE = re.compile(r"```(?:json)?(.*?)(?:```|\Z)", re.S)
+
+# Image formats Gemini accepts as-is (no decode / re-encode needed)
+_GEMINI_IMAGE_TYPES = frozenset({"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"})
+
+# Prompt and generation config are identical for every request, so they are built once
+_PROMPT = """Extract the details of the patient, doctor info and all the medicines prescribed here. 
+
+Make a JSON output with the following 3 keys with data within them:
+
+1. "doctor_info": Include Hospital Name and Address, Doctor Name, Registration Number
+2. "patient_info": Include Name, Age, Patient ID, Date
+3. "medicines": An array of medicine objects, each containing:
+   - Medicine Name
+   - Dosage (e.g., "500mg", "10ml")
+   - Dosage Instruction (e.g., "1-0-1", "2 times daily")
+   - Timing: "AF" (After Food) or "BF" (Before Food)
+   - Duration (e.g., "5 days", "1 week")
+
+Return ONLY valid JSON, no additional text or markdown formatting."""
+_PROMPT_PART = types.Part.from_text(text=_PROMPT)
+
+_GENERATE_CONTENT_CONFIG = types.GenerateContentConfig(
+    thinking_config=types.ThinkingConfig(
+        thinking_level="HIGH",
+    ),
+    # Google Search for medicine verification
+    tools=[types.Tool(googleSearch=types.GoogleSearch())],
+)
 
 
 class GeminiOCRService:
     """Service for performing OCR on medical prescriptions using Google Gemini."""
     
-    def __init__(self):
-        """Initialize the Gemini client."""
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable not set")
+    def __init__(
+        self,
+        client: Optional[genai.Client] = None,
+        cache_ttl: int = 3600,
+        cache_maxsize: int = 1024
+    ):
+        """
+        Initialize the Gemini client.
         
-        self.client = genai.Client(api_key=api_key)
+        Args:
+            client: Shared Gemini client (a pooled one is created if omitted)
+            cache_ttl: Seconds an extraction is reused for a re-uploaded identical file
+            cache_maxsize: Maximum number of cached extractions
+        """
+        self.client = client or create_genai_client()
         self.model = "gemini-3-pro-preview"
+        self._result_cache = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl)
+        self._cache_lock = threading.Lock()
     
-    def _image_to_base64(self, image: Image.Image) -> str:
-        """Convert PIL Image to base64 string."""
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode()
-    
-    def _pdf_to_images(self, pdf_bytes: bytes) -> list[Image.Image]:
-        """Convert PDF bytes to list of PIL Images."""
-        return convert_from_bytes(pdf_bytes)
+    def _pdf_first_page_jpeg(self, pdf_bytes: bytes) -> bytes:
+        """Render the first page of a PDF as JPEG bytes (only that page is OCR'd)."""
+        # Imported here so workers that never receive a PDF don't load pdf2image
+        from pdf2image import convert_from_bytes
+        
+        # pdftoppm writes the JPEG itself, so the file is read back as-is
+        # instead of being decoded into PIL and re-encoded
+        with tempfile.TemporaryDirectory() as output_folder:
+            paths = convert_from_bytes(
+                pdf_bytes,
+                first_page=1,
+                last_page=1,
+                fmt="jpeg",
+                output_folder=output_folder,
+                paths_only=True,
+                single_file=True
+            )
+            if not paths:
+                raise ValueError("PDF file contains no pages")
+            with open(paths[0], "rb") as f:
+                return f.read()
     
     def extract_prescription_data(self, file_bytes: bytes, mime_type: str) -> dict:
         """
@@ -40,50 +96,57 @@ class GeminiOCRService:
             mime_type: MIME type of the file (e.g., 'image/jpeg', 'application/pdf')
         
         Returns:
-            Dictionary containing extracted prescription data
+            Dictionary containing extracted prescription data (shared with the
+            cache, so callers must not mutate it)
+        """
+        # Retries and refreshes re-upload the same file, so reuse the earlier extraction
+        cache_key = (hashlib.sha256(file_bytes).hexdigest(), mime_type)
+        with self._cache_lock:
+            cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        extracted_data = self._run_ocr(file_bytes, mime_type)
+        
+        # Only successful extractions are cached, so parse failures are retried
+        if "error" not in extracted_data:
+            with self._cache_lock:
+                self._result_cache[cache_key] = extracted_data
+        
+        return extracted_data
+    
+    def _run_ocr(self, file_bytes: bytes, mime_type: str) -> dict:
+        """
+        Run Gemini OCR on an uploaded file.
+        
+        Args:
+            file_bytes: Raw bytes of the uploaded file
+            mime_type: MIME type of the file
+        
+        Returns:
+            Dictionary containing extracted prescription data, or error details
         """
         # Handle PDF files - convert to images first
         if mime_type == "application/pdf":
-            images = self._pdf_to_images(file_bytes)
             # For now, process only the first page
             # You can extend this to process multiple pages
-            if not images:
-                raise ValueError("PDF file contains no pages")
-            
-            image = images[0]
-            buffered = io.BytesIO()
-            image.save(buffered, format="JPEG")
-            file_bytes = buffered.getvalue()
+            file_bytes = self._pdf_first_page_jpeg(file_bytes)
             mime_type = "image/jpeg"
         
         # Handle image files
         elif mime_type.startswith("image/"):
-            # Convert to JPEG if needed
-            if mime_type not in ["image/jpeg", "image/jpg"]:
-                image = Image.open(io.BytesIO(file_bytes))
+            if mime_type == "image/jpg":
+                mime_type = "image/jpeg"
+            # Formats Gemini reads natively are sent as uploaded; others are converted to JPEG
+            if mime_type not in _GEMINI_IMAGE_TYPES:
+                image = Image.open(io.BytesIO(file_bytes)).convert("RGB")
                 buffered = io.BytesIO()
-                image.save(buffered, format="JPEG")
+                image.save(buffered, format="JPEG", quality=85)
                 file_bytes = buffered.getvalue()
                 mime_type = "image/jpeg"
         else:
             raise ValueError(f"Unsupported file type: {mime_type}")
         
-        # Prepare the prompt for Gemini
-        prompt = """Extract the details of the patient, doctor info and all the medicines prescribed here. 
-
-Make a JSON output with the following 3 keys with data within them:
-
-1. "doctor_info": Include Hospital Name and Address, Doctor Name, Registration Number
-2. "patient_info": Include Name, Age, Patient ID, Date
-3. "medicines": An array of medicine objects, each containing:
-   - Medicine Name
-   - Dosage (e.g., "500mg", "10ml")
-   - Dosage Instruction (e.g., "1-0-1", "2 times daily")
-   - Timing: "AF" (After Food) or "BF" (Before Food)
-   - Duration (e.g., "5 days", "1 week")
-
-Return ONLY valid JSON, no additional text or markdown formatting."""
-        
         # Create content for Gemini
         contents = [
             types.Content(
@@ -93,50 +156,32 @@ Return ONLY valid JSON, no additional text or markdown formatting."""
                         mime_type=mime_type,
                         data=file_bytes,
                     ),
-                    types.Part.from_text(text=prompt),
+                    _PROMPT_PART,
                 ],
             ),
         ]
         
-        # Configure tools (Google Search for medicine verification)
-        tools = [
-            types.Tool(googleSearch=types.GoogleSearch()),
-        ]
-        
-        generate_content_config = types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(
-                thinking_level="HIGH",
-            ),
-            tools=tools,
-        )
-        
         # Generate content
-        response_text = ""
+        response_parts = []
         for chunk in self.client.models.generate_content_stream(
             model=self.model,
             contents=contents,
-            config=generate_content_config,
+            config=_GENERATE_CONTENT_CONFIG,
         ):
             if chunk.text:
-                response_text += chunk.text
+                response_parts.append(chunk.text)
+        response_text = "".join(response_parts)
         
         # Parse the response
-        import json
         try:
-            # Try to extract JSON from the response
-            # Sometimes the model might wrap JSON in markdown code blocks
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-            elif "```" in response_text:
-                json_start = response_text.find("```") + 3
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
+            # The model sometimes wraps the JSON in a markdown code block
+            fence = _CODE_FENCE_RE.search(response_text)
+            if fence:
+                response_text = fence.group(1).strip()
             
-            extracted_data = json.loads(response_text)
+            extracted_data = orjson.loads(response_text)
             return extracted_data
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             # If JSON parsing fails, return the raw text
             return {
                 "error": "Failed to parse JSON response",
@@ -1,17 +1,65 @@
-import os
-import json
 import logging
-import re
 import base64
-import tempfile
-import wave
-import io
-from typing import List, Dict, Any, Optional, Tuple
+import hashlib
+import struct
+import threading
+import uuid
+import orjson
+from typing import List, Dict, Any, Optional
+from cachetools import TTLCache
 from google import genai
 from google.genai import types
+from app.services.clients import create_genai_client
 
 logger = logging.getLogger(__name__)
 
+# Stands in for the user's text when their message is sent as audio
+_AUDIO_MESSAGE_PLACEHOLDER = "(The user's message is the attached audio clip. Reply to what they say.)"
+
+# Gemini TTS returns raw PCM: Mono (1 channel), 24000 Hz, 16-bit (2 bytes)
+_TTS_CHANNELS = 1
+_TTS_SAMPLE_RATE = 24000
+_TTS_SAMPLE_WIDTH = 2
+
+# Speech synthesis settings, shared by every TTS call
+_TTS_CONFIG = types.GenerateContentConfig(
+    response_modalities=["AUDIO"],
+    speech_config=types.SpeechConfig(
+        voice_config=types.VoiceConfig(
+            prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                voice_name='Kore',
+            )
+        )
+    ),
+)
+
+
+def _sniff_audio_mime(audio_data: bytes) -> str:
+    """Guess an audio clip's MIME type from its leading bytes (defaults to MP3)."""
+    if audio_data[:4] == b"RIFF" and audio_data[8:12] == b"WAVE":
+        return "audio/wav"
+    if audio_data[:4] == b"OggS":
+        return "audio/ogg"
+    if audio_data[:4] == b"fLaC":
+        return "audio/flac"
+    if audio_data[:4] == b"\x1aE\xdf\xa3":
+        return "audio/webm"
+    if audio_data[4:8] == b"ftyp":
+        return "audio/mp4"
+    return "audio/mp3"
+
+
+def _wav_header(pcm_size: int) -> bytes:
+    """Build the 44-byte RIFF/WAVE header for a block of Gemini TTS PCM."""
+    block_align = _TTS_CHANNELS * _TTS_SAMPLE_WIDTH
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + pcm_size, b"WAVE",
+        b"fmt ", 16, 1, _TTS_CHANNELS, _TTS_SAMPLE_RATE,
+        _TTS_SAMPLE_RATE * block_align, block_align, _TTS_SAMPLE_WIDTH * 8,
+        b"data", pcm_size
+    )
+
 MEDICAL_CHAT_SYSTEM_PROMPT = """You are a professional, friendly, and patient medical intake voice agent.
 Your job is to collect accurate prescription-related information from the caller.
 Follow the conversation flow exactly as described below.
@@ -90,37 +138,72 @@ End politely:
 
 IMPORTANT INSTRUCTIONS FOR EXTRACTING INFORMATION:
 
-When the user provides their disease/symptoms, extract it and respond with JSON in this format:
-{"extracted_disease": "the disease/symptoms they mentioned"}
-
-When the user provides medicine names, extract them as a list and respond with JSON in this format:
-{"extracted_medicines": ["medicine1", "medicine2", "medicine3"]}
-
-When the user confirms or denies the medicine list, respond with JSON in this format:
-{"confirmation": true} or {"confirmation": false}
-
-Always include these JSON extractions in your response along with your conversational reply.
+Put your conversational reply in "reply".
+When the user provides their disease/symptoms, set "extracted_disease" to what they mentioned.
+When the user provides medicine names, set "extracted_medicines" to the list of names.
+When the user confirms or denies the medicine list, set "confirmation" to true or false.
+Leave out any field the user's latest message did not provide.
 """
 
+# Structured output: the reply and the extracted fields come back as one JSON object
+_CHAT_RESPONSE_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "reply": types.Schema(type=types.Type.STRING),
+        "extracted_disease": types.Schema(type=types.Type.STRING),
+        "extracted_medicines": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING)
+        ),
+        "confirmation": types.Schema(type=types.Type.BOOLEAN),
+    },
+    required=["reply"]
+)
+
+# Extracted reply field -> medical_information key it updates
+_EXTRACTED_FIELDS = {
+    "extracted_disease": "reported_disease",
+    "extracted_medicines": "medications_provided_by_user",
+    "confirmation": "medication_confirmation",
+}
+
+_CHAT_CONFIG = types.GenerateContentConfig(
+    system_instruction=MEDICAL_CHAT_SYSTEM_PROMPT,
+    temperature=0.7,
+    response_mime_type="application/json",
+    response_schema=_CHAT_RESPONSE_SCHEMA
+)
+
 
 class MedicalChatService:
     """Service for handling medical intake conversations using Google Gemini."""
     
-    def __init__(self, model_name: str = "gemini-3-flash-preview"):
+    def __init__(
+        self,
+        model_name: str = "gemini-3-flash-preview",
+        client: Optional[genai.Client] = None,
+        cache_ttl: int = 3600,
+        history_window: int = 8
+    ):
         """
         Initialize the medical chat service.
         
         Args:
             model_name: Name of the Gemini model to use
+            client: Shared Gemini client (a pooled one is created if omitted)
+            cache_ttl: Seconds a generated reply / audio clip is reused for identical input
+            history_window: Number of most recent conversation messages sent to the model
         """
         self.model_name = model_name
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLEAPIKEY")
-        
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY or GOOGLEAPIKEY environment variable must be set")
-        
-        self.client = genai.Client(api_key=api_key)
-        logger.info(f"MedicalChatService initialized with model: {model_name}")
+        self.client = client or create_genai_client()
+        self.history_window = history_window
+        # Replies keyed by prompt digest; audio keyed by reply text with a ~64MB budget
+        self._response_cache = TTLCache(maxsize=4096, ttl=cache_ttl)
+        self._audio_cache = TTLCache(maxsize=64 * 1024 * 1024, ttl=cache_ttl, getsizeof=len)
+        # Generated clips served over GET (see store_audio_clip), ~32MB / 10 minutes
+        self._audio_clips = TTLCache(maxsize=32 * 1024 * 1024, ttl=600, getsizeof=len)
+        self._cache_lock = threading.Lock()
+        logger.info("MedicalChatService initialized with model: %s", model_name)
     
     def _build_conversation_context(
         self, 
@@ -168,51 +251,7 @@ class MedicalChatService:
         
         return "\n".join(context_parts)
     
-    def _transcribe_audio(self, audio_base64: str) -> str:
-        """
-        Transcribe audio to text using Gemini.
-        
-        Args:
-            audio_base64: Base64 encoded audio data
-            
-        Returns:
-            Transcribed text
-        """
-        try:
-            # Decode base64 audio
-            audio_data = base64.b64decode(audio_base64)
-            
-            # Save to temporary file
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio:
-                temp_audio.write(audio_data)
-                temp_audio_path = temp_audio.name
-            
-            try:
-                # Upload audio file to Gemini
-                logger.info("Uploading audio file to Gemini for transcription")
-                myfile = self.client.files.upload(file=temp_audio_path)
-                
-                # Transcribe using Gemini
-                response = self.client.models.generate_content(
-                    model="gemini-3-flash-preview",
-                    contents=["Transcribe this audio clip. Only return the transcribed text, nothing else.", myfile]
-                )
-                
-                transcribed_text = response.text.strip()
-                logger.info(f"Audio transcribed: {transcribed_text[:50]}...")
-                
-                return transcribed_text
-            
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_audio_path):
-                    os.unlink(temp_audio_path)
-        
-        except Exception as e:
-            logger.error(f"Audio transcription failed: {str(e)}")
-            raise Exception(f"Failed to transcribe audio: {str(e)}")
-    
-    def _generate_audio_response(self, text: str) -> str:
+    async def _generate_audio_wav(self, text: str) -> bytes:
         """
         Generate audio response from text using Gemini TTS.
         
@@ -220,25 +259,22 @@ class MedicalChatService:
             text: Text to convert to speech
             
         Returns:
-            Base64 encoded audio data
+            WAV file bytes
         """
+        with self._cache_lock:
+            cached_audio = self._audio_cache.get(text)
+        if cached_audio is not None:
+            logger.info("Using cached audio response")
+            return cached_audio
+        
         try:
             logger.info("Generating audio response using Gemini TTS")
             
             # Using the new TTS model which returns raw PCM
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model="gemini-2.5-flash-preview-tts",
                 contents=text,
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name='Kore',
-                            )
-                        )
-                    ),
-                )
+                config=_TTS_CONFIG
             )
             
             # Extract raw PCM audio data
@@ -248,74 +284,89 @@ class MedicalChatService:
                 
             pcm_data = response.candidates[0].content.parts[0].inline_data.data
             
-            # Create a WAV file in memory from the raw PCM data
-            # Gemini TTS typically returns: Mono (1 channel), 24000 Hz, 16-bit (2 bytes)
-            with io.BytesIO() as wav_buffer:
-                with wave.open(wav_buffer, "wb") as wf:
-                    wf.setnchannels(1)        # Mono
-                    wf.setsampwidth(2)        # 16-bit
-                    wf.setframerate(24000)    # 24kHz
-                    wf.writeframes(pcm_data)
-                
-                # Get the WAV file bytes
-                wav_data = wav_buffer.getvalue()
-                
-                # Encode to base64
-                audio_base64 = base64.b64encode(wav_data).decode('utf-8')
+            # Prefix the raw PCM with a WAV header (one concatenation, no wave/BytesIO copies)
+            wav_data = _wav_header(len(pcm_data)) + pcm_data
             
-            logger.info(f"Audio response generated successfully ({len(audio_base64)} chars)")
-            return audio_base64
+            logger.info("Audio response generated successfully (%d bytes)", len(wav_data))
+            with self._cache_lock:
+                self._audio_cache[text] = wav_data
+            return wav_data
         
         except Exception as e:
-            logger.error(f"Audio generation failed: {str(e)}")
+            logger.error("Audio generation failed: %s", e)
             # We don't want to crash the whole chat if audio fails, 
             # so we log deeply but raise to let the caller handle it (which catches and logs warning)
             raise Exception(f"Failed to generate audio response: {str(e)}")
     
-    def _extract_information_from_response(self, response_text: str) -> Tuple[str, Dict[str, Any]]:
+    async def generate_audio_wav(self, text: str) -> Optional[bytes]:
         """
-        Extract structured information from AI response.
+        Generate a spoken version of a reply as WAV bytes, tolerating TTS failures.
         
         Args:
-            response_text: Raw response from Gemini
+            text: Reply text to convert to speech
             
         Returns:
-            Tuple of (clean_response, extracted_data)
+            WAV file bytes, or None if generation failed
         """
-        extracted_data = {}
-        clean_response = response_text
-        
-        # Remove markdown code blocks (```json ... ```)
-        clean_response = re.sub(r'```json\s*', '', clean_response)
-        clean_response = re.sub(r'```\s*', '', clean_response)
+        try:
+            return await self._generate_audio_wav(text)
+        except Exception as e:
+            logger.warning("Failed to generate audio response: %s", e)
+            # Continue without audio response
+            return None
+    
+    async def generate_audio_response(self, text: str) -> Optional[str]:
+        """
+        Generate a spoken version of a reply, tolerating TTS failures.
         
-        # Try to find JSON patterns in the response
-        json_pattern = r'\{[^}]+\}'
-        matches = re.findall(json_pattern, clean_response)
+        Args:
+            text: Reply text to convert to speech
+            
+        Returns:
+            Base64 encoded WAV audio, or None if generation failed
+        """
+        wav_data = await self.generate_audio_wav(text)
+        return base64.b64encode(wav_data).decode('utf-8') if wav_data is not None else None
+    
+    def store_audio_clip(self, wav_data: bytes) -> str:
+        """
+        Keep a generated clip so clients can download it as binary audio.
         
-        for match in matches:
-            try:
-                data = json.loads(match)
-                extracted_data.update(data)
-                # Remove JSON from the response text
-                clean_response = clean_response.replace(match, "").strip()
-            except json.JSONDecodeError:
-                continue
+        Clips live in this process for a few minutes only.
         
-        # Clean up extra whitespace and newlines
-        clean_response = re.sub(r'\n\s*\n', '\n', clean_response)  # Remove multiple blank lines
-        clean_response = clean_response.strip()
+        Args:
+            wav_data: WAV file bytes
+            
+        Returns:
+            Clip ID for get_audio_clip
+        """
+        clip_id = uuid.uuid4().hex
+        with self._cache_lock:
+            self._audio_clips[clip_id] = wav_data
+        return clip_id
+    
+    def get_audio_clip(self, clip_id: str) -> Optional[bytes]:
+        """
+        Fetch a clip stored by store_audio_clip.
         
-        return clean_response, extracted_data
+        Args:
+            clip_id: Clip ID
+            
+        Returns:
+            WAV file bytes, or None if unknown or expired
+        """
+        with self._cache_lock:
+            return self._audio_clips.get(clip_id)
     
-    def chat(
+    async def chat(
         self,
         user_message: Optional[str] = None,
         audio_base64: Optional[str] = None,
         conversation_history: List[Dict[str, str]] = None,
         medical_information: Optional[Dict[str, Any]] = None,
         prescription_data: Optional[Dict[str, Any]] = None,
-        return_audio: bool = True
+        return_audio: bool = True,
+        audio_bytes: Optional[bytes] = None
     ) -> Dict[str, Any]:
         """
         Process a user message and generate a response.
@@ -327,15 +378,21 @@ class MedicalChatService:
             medical_information: Collected medical information
             prescription_data: Prescription data from OCR if available
             return_audio: Whether to generate audio response
+            audio_bytes: The user's message (raw audio bytes, instead of audio_base64)
             
         Returns:
             Dictionary with response, audio_response_base64, updated medical information, and completion status
         """
         try:
-            # Handle audio input if provided
-            if audio_base64 and not user_message:
-                logger.info("Transcribing audio input")
-                user_message = self._transcribe_audio(audio_base64)
+            # Spoken input goes straight to the chat model with the turn, instead of
+            # a separate transcription call before it
+            audio_part = None
+            audio_digest = ""
+            if (audio_bytes or audio_base64) and not user_message:
+                audio_data = audio_bytes or base64.b64decode(audio_base64)
+                audio_part = types.Part.from_bytes(data=audio_data, mime_type=_sniff_audio_mime(audio_data))
+                audio_digest = hashlib.sha256(audio_data).hexdigest()
+                user_message = _AUDIO_MESSAGE_PLACEHOLDER
             
             if not user_message:
                 raise ValueError("Either message or audio_base64 must be provided")
@@ -349,52 +406,76 @@ class MedicalChatService:
                 prescription_data
             )
             
-            # Build the full conversation for Gemini
-            messages = []
-            
-            # Add context as system message if available
-            if context:
-                messages.append(f"CONTEXT:\n{context}\n\nCONVERSATION:")
-            
-            # Add conversation history
-            for msg in conversation_history:
-                role = msg.get("role", "user")
+            # Send the history as real turns ahead of the changing context, so the
+            # system prompt + earlier turns form a stable prefix that Gemini's
+            # implicit context caching can reuse from one turn to the next
+            # Only the most recent messages are sent; what was collected earlier is
+            # already carried in the COLLECTED INFORMATION context
+            turns = []
+            for msg in conversation_history[-self.history_window:]:
                 content = msg.get("content", "")
-                messages.append(f"{role.upper()}: {content}")
-            
-            # Add current user message
-            messages.append(f"USER: {user_message}")
-            
-            full_prompt = "\n".join(messages)
+                if content:
+                    role = "model" if str(msg.get("role", "")).lower() in ("assistant", "model") else "user"
+                    turns.append((role, content))
             
-            logger.info(f"Sending chat request to Gemini")
-            
-            # Generate response
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                config=types.GenerateContentConfig(
-                    system_instruction=MEDICAL_CHAT_SYSTEM_PROMPT,
-                    temperature=0.7
-                ),
-                contents=[full_prompt]
-            )
-            
-            response_text = response.text
+            # Context (prescription, collected info) goes with the current user message
+            if context:
+                turns.append(("user", f"CONTEXT:\n{context}\n\nUSER: {user_message}"))
+            else:
+                turns.append(("user", user_message))
+            
+            # Opening turns repeat across users; reuse the reply for an identical prompt
+            cache_key = hashlib.sha256(
+                "\x1e".join(f"{role}\x1f{text}" for role, text in turns).encode("utf-8")
+            ).hexdigest() + audio_digest
+            with self._cache_lock:
+                response_text = self._response_cache.get(cache_key)
+            
+            if response_text is None:
+                logger.info("Sending chat request to Gemini")
+                contents = [
+                    types.Content(role=role, parts=[types.Part.from_text(text=text)])
+                    for role, text in turns
+                ]
+                if audio_part is not None:
+                    contents[-1].parts.append(audio_part)
+                
+                # Generate response
+                response = await self.client.aio.models.generate_content(
+                    model=self.model_name,
+                    config=_CHAT_CONFIG,
+                    contents=contents
+                )
+                
+                response_text = response.text
+                with self._cache_lock:
+                    self._response_cache[cache_key] = response_text
+            else:
+                logger.info("Using cached chat response")
             
-            # Extract structured information from response
-            clean_response, extracted_data = self._extract_information_from_response(response_text)
+            # Reply and extracted fields arrive as one schema-constrained JSON object
+            try:
+                extracted_data = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
+                logger.warning("Chat response was not valid JSON, using it as the reply")
+                extracted_data = {"reply": response_text}
+            if not isinstance(extracted_data, dict):
+                logger.warning("Chat response was not a JSON object, using it as the reply")
+                extracted_data = {"reply": response_text}
+            reply = extracted_data.pop("reply", None)
+            clean_response = (reply.strip() if isinstance(reply, str) else "") or response_text.strip()
             
             # Update medical information based on extracted data
-            updated_medical_info = medical_information.copy() if medical_information else {}
-            
-            if "extracted_disease" in extracted_data:
-                updated_medical_info["reported_disease"] = extracted_data["extracted_disease"]
-            
-            if "extracted_medicines" in extracted_data:
-                updated_medical_info["medications_provided_by_user"] = extracted_data["extracted_medicines"]
-            
-            if "confirmation" in extracted_data:
-                updated_medical_info["medication_confirmation"] = extracted_data["confirmation"]
+            # (the caller's dict is passed back untouched when nothing was extracted)
+            updates = {
+                _EXTRACTED_FIELDS[key]: value
+                for key, value in extracted_data.items()
+                if key in _EXTRACTED_FIELDS
+            }
+            if updates:
+                updated_medical_info = {**(medical_information or {}), **updates}
+            else:
+                updated_medical_info = medical_information or {}
             
             # Check if conversation is complete
             conversation_complete = (
@@ -403,25 +484,20 @@ class MedicalChatService:
                 updated_medical_info.get("medication_confirmation") is not None
             )
             
-            logger.info(f"Chat response generated. Complete: {conversation_complete}")
+            logger.info("Chat response generated. Complete: %s", conversation_complete)
             
             # Generate audio response if requested
             audio_response_base64 = None
-            if return_audio:
-                try:
-                    response_for_audio = clean_response if clean_response else response_text
-                    audio_response_base64 = self._generate_audio_response(response_for_audio)
-                except Exception as e:
-                    logger.warning(f"Failed to generate audio response: {str(e)}")
-                    # Continue without audio response
+            if return_audio and clean_response:
+                audio_response_base64 = await self.generate_audio_response(clean_response)
             
             return {
-                "response": clean_response if clean_response else response_text,
+                "response": clean_response,
                 "audio_response_base64": audio_response_base64,
                 "updated_medical_information": updated_medical_info,
                 "conversation_complete": conversation_complete
             }
             
         except Exception as e:
-            logger.error(f"Chat processing failed: {str(e)}")
+            logger.error("Chat processing failed: %s", e)
             raise Exception(f"Medical chat failed: {str(e)}")
@@ -1,103 +1,393 @@
 import os
-import json
+import re
+import asyncio
 import logging
-from typing import List, Dict, Any
+import threading
+import orjson
+from typing import List, Dict, Any, Optional, Tuple
+from cachetools import TTLCache
 from google import genai
 from google.genai import types
+from app.services.clients import create_genai_client
 
 logger = logging.getLogger(__name__)
 
-SYSTEM_PROMPT = """
-You are a medical regulatory assistant specializing in Indian pharmaceutical regulations.
-Your task is to analyze a list of medicines and determine if any of them are:
-1. Banned in India.
-2. Not for sale (e.g., discontinued, withdrawn).
-3. Classified as a Narcotic or Psychotropic substance under the NDPS Act.
+# Per-call bound for safety checks (tighter than the client-wide OCR timeout), with
+# transient 429/5xx answers and connection errors retried with jittered backoff
+_SAFETY_TIMEOUT_MS = int(os.environ.get("MEDICINE_SAFETY_TIMEOUT_MS", "60000"))
+_SAFETY_HTTP_OPTIONS = types.HttpOptions(
+    timeout=_SAFETY_TIMEOUT_MS,
+    retry_options=types.HttpRetryOptions(
+        attempts=3,
+        initial_delay=1.0,
+        max_delay=10.0,
+        http_status_codes=[429, 500, 502, 503, 504]
+    )
+)
 
-Input:
-A JSON object containing a list of medicines.
+SYSTEM_PROMPT = """You are a medical regulatory assistant for Indian pharmaceutical regulations.
+For each medicine (one per line), set flagged to true if it is banned in India, not for sale
+(discontinued or withdrawn), or a narcotic/psychotropic substance under the NDPS Act; otherwise false.
+For a combination, judge the specific combination. Answer in the order given, echoing each
+medicine_name exactly.
+"""
 
-Output:
-A JSON list of objects with the following structure:
-[
-  {
-    "medicine_name": "Name from input",
-    "flagged": true | false
-  }
-]
+# Structured output: Gemini must answer with exactly this shape
+_SAFETY_RESPONSE_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "medicine_name": types.Schema(type=types.Type.STRING),
+            "flagged": types.Schema(type=types.Type.BOOLEAN),
+        },
+        required=["medicine_name", "flagged"]
+    )
+)
+
+# Identical for every call, so built (and validated) once
+_SAFETY_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_PROMPT,
+    response_mime_type="application/json",
+    response_schema=_SAFETY_RESPONSE_SCHEMA,
+    http_options=_SAFETY_HTTP_OPTIONS
+)
+
+
+def _medicine_key(name: str) -> str:
+    """Normalize a medicine name for caching and de-duplication."""
+    return " ".join(name.lower().split())
+
+
+def _index_flags(medicines: List[str], results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Map normalized medicine names to the flagged status Gemini returned.
+    
+    Results are matched by the medicine name Gemini echoed back. Only when it
+    returned one result per input is an entry whose echoed name matches no
+    medicine assigned by position (to a medicine not matched by name).
+    """
+    keys = [_medicine_key(name) for name in medicines]
+    wanted = set(keys)
+    flags = {}
+    unmatched = []
+    for position, result in enumerate(results):
+        flagged = result.get("flagged")
+        if flagged is None:
+            continue
+        key = _medicine_key(str(result.get("medicine_name", "")))
+        if key in wanted and key not in flags:
+            flags[key] = flagged
+        else:
+            unmatched.append((position, flagged))
+    
+    if len(results) == len(medicines):
+        for position, flagged in unmatched:
+            flags.setdefault(keys[position], flagged)
+    return flags
 
-Do not include any other fields or text. The `flagged` field should be true if the medicine is banned, restricted (narcotic/psychotropic), or withdrawn. Otherwise false.
-Analyze each medicine carefully using your knowledge base up to late 2024/early 2025.
-If a medicine is a combination, check if the specific combination is banned.
-"""
+
+def _unanswered(medicines: List[str], flags: Dict[str, Any]) -> List[str]:
+    """Medicines with no flagged status in flags."""
+    return [name for name in medicines if _medicine_key(name) not in flags]
 
 
 class MedicineSafetyService:
     """Service for checking medicine safety using Google Gemini."""
     
-    def __init__(self, model_name: str = "gemini-3-pro-preview"):
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        fallback_model_name: Optional[str] = "gemini-3-pro-preview",
+        client: Optional[genai.Client] = None,
+        denylist_path: Optional[str] = None,
+        allowlist_path: Optional[str] = None,
+        cache_ttl: int = 600,
+        cache_maxsize: int = 10_000,
+        batch_size: Optional[int] = None,
+        batch_window: float = 0.05,
+        concurrency_limit: Optional[asyncio.Semaphore] = None
+    ):
         """
         Initialize the medicine safety service.
         
         Args:
-            model_name: Name of the Gemini model to use
+            model_name: Name of the Gemini model to use (defaults to GEMINI_SAFETY_MODEL,
+                or gemini-3-flash-preview)
+            fallback_model_name: Model re-asked when the first answer is malformed or
+                incomplete (None disables the fallback)
+            client: Shared Gemini client (a pooled one is created if omitted)
+            denylist_path: Optional file of known banned/restricted medicine names,
+                one per line (defaults to MEDICINE_DENYLIST_PATH)
+            allowlist_path: Optional file of medicine names known to be unrestricted,
+                one per line (defaults to MEDICINE_ALLOWLIST_PATH)
+            cache_ttl: Seconds a medicine's result is reused before asking Gemini again
+            cache_maxsize: Maximum number of cached medicine results
+            batch_size: Most medicines sent in one Gemini call (defaults to
+                MEDICINE_SAFETY_BATCH_SIZE, or 10)
+            batch_window: Seconds cache misses from concurrent calls are collected
+                before they are sent to Gemini together
+            concurrency_limit: Semaphore bounding in-flight Gemini calls (pass the
+                shared upstream one; defaults to a private limit of 8)
+        """
+        self.model_name = model_name or os.environ.get("GEMINI_SAFETY_MODEL", "gemini-3-flash-preview")
+        self.fallback_model_name = fallback_model_name
+        self.client = client or create_genai_client()
+        self._denylist_pattern = self._compile_name_list(
+            denylist_path or os.environ.get("MEDICINE_DENYLIST_PATH")
+        )
+        self._allowlist_pattern = self._compile_name_list(
+            allowlist_path or os.environ.get("MEDICINE_ALLOWLIST_PATH")
+        )
+        # Flagged status keyed by normalized medicine name
+        self._result_cache = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl)
+        self._cache_lock = threading.Lock()
+        # Micro-batching: misses from concurrent calls wait up to batch_window and
+        # are sent together; a name already pending or in flight is not re-sent
+        self.batch_size = batch_size or int(os.environ.get("MEDICINE_SAFETY_BATCH_SIZE", "10"))
+        self.batch_window = batch_window
+        self._pending: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks = set()
+        self._concurrency_limit = concurrency_limit or asyncio.Semaphore(8)
+        logger.info("MedicineSafetyService initialized with model: %s", self.model_name)
+    
+    @staticmethod
+    def _compile_name_list(path: Optional[str]) -> Optional[re.Pattern]:
+        """
+        Compile a file of medicine names into one case-insensitive pattern.
+        
+        A single alternation lets each medicine be matched against the whole
+        list in one scan instead of looping over every listed name.
+        
+        Args:
+            path: Path to a text file with one name per line ('#' starts a comment)
+            
+        Returns:
+            Compiled pattern, or None if no list is configured
         """
-        self.model_name = model_name
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLEAPIKEY")
+        if not path:
+            return None
         
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY or GOOGLEAPIKEY environment variable must be set")
+        with open(path, encoding="utf-8") as f:
+            names = {line.split("#", 1)[0].strip().lower() for line in f}
+        names.discard("")
+        if not names:
+            return None
         
-        self.client = genai.Client(api_key=api_key)
-        logger.info(f"MedicineSafetyService initialized with model: {model_name}")
+        # Longest names first so combinations win over their single ingredients
+        alternation = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+        logger.info("Loaded %d medicine names from %s", len(names), path)
+        return re.compile(rf"\b(?:{alternation})\b", re.IGNORECASE)
     
-    def check_medicines(self, medicines: List[str]) -> List[Dict[str, Any]]:
+    async def check_medicines(self, medicines: List[str]) -> List[Dict[str, Any]]:
         """
         Check if medicines are safe (not banned/restricted/withdrawn).
         
+        Names are de-duplicated case- and whitespace-insensitively. Names on the
+        local deny-list or allow-list, or checked within the cache TTL, are answered
+        without Gemini; only the remaining distinct names are sent.
+        
         Args:
             medicines: List of medicine names to check
             
         Returns:
-            List of dictionaries with medicine_name and flagged status
+            List of dictionaries with medicine_name (as given) and flagged status,
+            one per input name in input order
             
         Raises:
-            Exception: If the API call fails
+            Exception: If the API call fails, or Gemini leaves a medicine unanswered
         """
         if not medicines:
             return []
         
-        # Create the input data structure
-        input_data = {
-            "data": {
-                "medicines": medicines
-            }
-        }
+        # Normalized name -> flagged, for names answered without Gemini
+        flags = {}
+        misses = {}
+        for name in medicines:
+            key = _medicine_key(name)
+            if key in flags or key in misses:
+                continue
+            if self._denylist_pattern is not None and self._denylist_pattern.search(name):
+                flags[key] = True
+            # The whole name must be listed: an allowed ingredient inside a
+            # combination (which may be a banned FDC) still goes to Gemini
+            elif self._allowlist_pattern is not None and self._allowlist_pattern.fullmatch(key):
+                flags[key] = False
+            else:
+                misses[key] = " ".join(name.split())
+        
+        with self._cache_lock:
+            for key in list(misses):
+                cached = self._result_cache.get(key)
+                if cached is not None:
+                    flags[key] = cached
+                    del misses[key]
+        
+        logger.info(
+            "Safety check: %d answered locally or from cache, %d sent to Gemini",
+            len(flags), len(misses)
+        )
+        
+        if misses:
+            flags.update(await self._coalesced_query(misses))
+        
+        return [{"medicine_name": name, "flagged": flags[_medicine_key(name)]} for name in medicines]
+    
+    async def _coalesced_query(self, misses: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Queue medicines for the next batched Gemini call and wait for their results.
+        
+        Args:
+            misses: Normalized name -> medicine name, for names not cached
+            
+        Returns:
+            Normalized name -> flagged, for every queued name
+            
+        Raises:
+            Exception: If a batch's API call fails or leaves a medicine unanswered
+        """
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for key, name in misses.items():
+            future = self._in_flight.get(key)
+            if future is None:
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = (name, loop.create_future())
+                future = pending[1]
+            futures[key] = future
         
-        prompt = f"Analyze the following medicines:\n{json.dumps(medicines, indent=2)}"
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._pending and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        
+        # Shielded: a cancelled request must not cancel results other callers share
+        results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return dict(zip(futures, results))
+    
+    def _flush(self):
+        """Send every pending medicine to Gemini, batch_size names per call."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
         
+        pending = list(self._pending.items())
+        self._pending = {}
+        for i in range(0, len(pending), self.batch_size):
+            batch = dict(pending[i:i + self.batch_size])
+            self._in_flight.update((key, future) for key, (_, future) in batch.items())
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, batch: Dict[str, Tuple[str, asyncio.Future]]):
+        """
+        Check one batch with Gemini, cache the results and resolve its waiters.
+        
+        Args:
+            batch: Normalized name -> (medicine name, future resolved with its flagged status)
+        """
         try:
-            logger.info(f"Checking safety for {len(medicines)} medicines")
+            names = [name for name, _ in batch.values()]
+            # Only complete answers come back, so a partial batch is never cached
+            async with self._concurrency_limit:
+                fetched = await self._query_gemini(names)
+            with self._cache_lock:
+                self._result_cache.update(fetched)
+            for key, (_, future) in batch.items():
+                if not future.done():
+                    future.set_result(fetched[key])
+        except Exception as e:
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for key in batch:
+                self._in_flight.pop(key, None)
+    
+    async def _query_gemini(self, medicines: List[str]) -> Dict[str, Any]:
+        """
+        Ask Gemini to flag banned/restricted/withdrawn medicines.
+        
+        The fast model answers first; the answer is re-requested from the fallback
+        model only if it is malformed or doesn't cover every medicine.
+        
+        Args:
+            medicines: List of medicine names to check
+            
+        Returns:
+            Normalized name -> flagged, for every medicine
             
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                config=types.GenerateContentConfig(
-                    system_instruction=SYSTEM_PROMPT,
-                    response_mime_type="application/json"
-                ),
+        Raises:
+            Exception: If the API call fails, or a medicine is still unanswered
+        """
+        try:
+            fetched = _index_flags(medicines, await self._ask_model(self.model_name, medicines))
+            missing = _unanswered(medicines, fetched)
+            if not missing:
+                return fetched
+            if not self.fallback_model_name:
+                raise Exception(f"Medicine safety check failed: no result for {', '.join(missing)}")
+            logger.warning(
+                "%s left %d of %d medicines unanswered, retrying with %s",
+                self.model_name, len(missing), len(medicines), self.fallback_model_name
+            )
+        except ValueError:
+            if not self.fallback_model_name:
+                raise
+            logger.warning("Retrying malformed %s answer with %s", self.model_name, self.fallback_model_name)
+        
+        fetched = _index_flags(medicines, await self._ask_model(self.fallback_model_name, medicines))
+        missing = _unanswered(medicines, fetched)
+        if missing:
+            raise Exception(f"Medicine safety check failed: no result for {', '.join(missing)}")
+        return fetched
+    
+    async def _ask_model(self, model_name: str, medicines: List[str]) -> List[Dict[str, Any]]:
+        """
+        Run one safety-check request against a specific Gemini model.
+        
+        Args:
+            model_name: Gemini model to ask
+            medicines: List of medicine names to check
+            
+        Returns:
+            List of dictionaries with medicine_name and flagged status
+            
+        Raises:
+            ValueError: If the response is not a JSON list
+            Exception: If the API call fails
+        """
+        # One name per line: fewer input tokens than an indented JSON list
+        prompt = "\n".join(medicines)
+        
+        try:
+            logger.info("Checking safety for %d medicines with %s", len(medicines), model_name)
+            
+            response = await self.client.aio.models.generate_content(
+                model=model_name,
+                config=_SAFETY_CONFIG,
                 contents=[prompt]
             )
             
             # Parse the JSON response
-            result = json.loads(response.text)
+            result = orjson.loads(response.text)
+            if not isinstance(result, list):
+                raise ValueError(f"Invalid JSON response from Gemini: expected a list, got {type(result).__name__}")
             
-            logger.info(f"Successfully checked {len(result)} medicines")
+            logger.info("Successfully checked %d medicines", len(result))
             return result
             
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse Gemini response as JSON: {str(e)}")
-            raise Exception(f"Invalid JSON response from Gemini: {str(e)}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Failed to parse Gemini response as JSON: %s", e)
+            raise ValueError(f"Invalid JSON response from Gemini: {str(e)}")
+        
+        except ValueError:
+            raise
         
         except Exception as e:
-            logger.error(f"Gemini analysis failed: {str(e)}")
+            logger.error("Gemini analysis failed: %s", e)
             raise Exception(f"Medicine safety check failed: {str(e)}")
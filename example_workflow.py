@@ -12,6 +12,8 @@ class MedicalAssistant:
     """Helper class to manage medical chat conversations."""
     
     def __init__(self):
+        # Keep-alive session so every turn reuses one connection to the API
+        self.session = requests.Session()
         self.conversation_history = []
         self.medical_information = {
             "reported_disease": None,
@@ -22,7 +24,7 @@ class MedicalAssistant:
     
     def chat(self, message):
         """Send a message and get response."""
-        response = requests.post(
+        response = self.session.post(
             f"{BASE_URL}/medical-chat",
             json={
                 "message": message,
@@ -60,7 +62,7 @@ class MedicalAssistant:
         if not medicines:
             return None
         
-        response = requests.post(
+        response = self.session.post(
             f"{BASE_URL}/check-medicine-safety",
             json={"medicines": medicines}
         )
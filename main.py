@@ -1,12 +1,28 @@
 import os
+import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 # Load environment variables FIRST before any other imports
 load_dotenv()
 
+# Configure logging once for the whole application
+logging.basicConfig(level=logging.INFO)
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.api.routes import router
+from app.api.routes import router, MAX_UPLOAD_REQUEST_SIZE
+from app.api.middleware import UploadSizeLimitMiddleware
+from app.api.dependencies import init_services, close_upstream_clients
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application lifespan: build services on startup, release upstream connections on shutdown."""
+    init_services()
+    yield
+    await close_upstream_clients()
+
 
 # Create FastAPI app
 app = FastAPI(
@@ -14,9 +30,14 @@ app = FastAPI(
     description="API for extracting prescription details using Google Gemini OCR",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
+# Reject oversized uploads from Content-Length before the body is read
+# (added before CORS so CORS wraps it and the 413 carries CORS headers)
+app.add_middleware(UploadSizeLimitMiddleware, max_body_size=MAX_UPLOAD_REQUEST_SIZE)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -48,9 +69,19 @@ if __name__ == "__main__":
         print("WARNING: GEMINI_API_KEY environment variable not set!")
         print("Please set it in your .env file or environment")
     
+    # Auto-reload only in development (the default). One worker by default:
+    # /medical-chat/voice audio_url clips live in a per-process cache, so extra
+    # workers (UVICORN_WORKERS) need sticky routing or those links 404.
+    # "auto" picks uvloop / httptools when installed (uvicorn[standard]) and
+    # falls back to asyncio / h11 otherwise
+    reload = os.environ.get("ENV", "dev") == "dev"
+    workers = 1 if reload else int(os.environ.get("UVICORN_WORKERS") or 1)
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=reload,
+        workers=workers,
+        loop="auto",
+        http="auto"
     )
@@ -10,6 +10,9 @@ import os
 
 BASE_URL = "http://localhost:8000/api/v1"
 
+# One keep-alive connection reused by every request in the script
+SESSION = requests.Session()
+
 
 def save_audio_from_base64(audio_base64: str, filename: str):
     """Save base64 encoded audio to a WAV file."""
@@ -44,7 +47,7 @@ def test_text_chat():
     
     print(f"\n📤 Sending text message: '{payload['message']}'")
     
-    response = requests.post(f"{BASE_URL}/medical-chat", json=payload)
+    response = SESSION.post(f"{BASE_URL}/medical-chat", json=payload)
     
     if response.status_code == 200:
         result = response.json()
@@ -88,7 +91,7 @@ def test_audio_chat():
     
     print(f"📤 Sending audio ({len(audio_base64)} chars base64)")
     
-    response = requests.post(f"{BASE_URL}/medical-chat", json=payload)
+    response = SESSION.post(f"{BASE_URL}/medical-chat", json=payload)
     
     if response.status_code == 200:
         result = response.json()
@@ -133,7 +136,7 @@ def test_conversation_flow():
             "prescription_data": None
         }
         
-        response = requests.post(f"{BASE_URL}/medical-chat", json=payload)
+        response = SESSION.post(f"{BASE_URL}/medical-chat", json=payload)
         
         if response.status_code == 200:
             result = response.json()
@@ -6,6 +6,9 @@ import json
 
 BASE_URL = "http://localhost:8000/api/v1"
 
+# One keep-alive connection reused by every request in the script
+SESSION = requests.Session()
+
 def test_medicine_safety():
     """Test the medicine safety check endpoint."""
     print("\n" + "="*60)
@@ -25,7 +28,7 @@ def test_medicine_safety():
     
     print(f"\nChecking safety for medicines: {payload['medicines']}")
     
-    response = requests.post(f"{BASE_URL}/check-medicine-safety", json=payload)
+    response = SESSION.post(f"{BASE_URL}/check-medicine-safety", json=payload)
     
     print(f"\nStatus Code: {response.status_code}")
     print(f"\nResponse:")
@@ -78,7 +81,7 @@ def test_medical_chat():
         print(f"\n--- Conversation Turn {i} ---")
         print(f"User: {conv['message']}")
         
-        response = requests.post(f"{BASE_URL}/medical-chat", json=conv)
+        response = SESSION.post(f"{BASE_URL}/medical-chat", json=conv)
         
         print(f"Status Code: {response.status_code}")
         
@@ -102,7 +105,7 @@ def test_health():
     print("Testing Health Check Endpoint")
     print("="*60)
     
-    response = requests.get(f"{BASE_URL}/health")
+    response = SESSION.get(f"{BASE_URL}/health")
     print(f"\nStatus Code: {response.status_code}")
     print(f"Response: {response.json()}")
 